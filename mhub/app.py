@@ -13,7 +13,6 @@ MHub Applications Module
 
 import logging
 
-from pymongo import Connection
 from twisted.application.service import MultiService, Application
 from twisted.internet import reactor
 
@@ -44,6 +43,7 @@ class MHubApp(object):
         self.reactor = reactor
         self.root_service = MultiService()
         self.service = MHubService(self.cfg, self.reactor, self)
+        self.service.setServiceParent(self.root_service)
         self.application = Application("mhub")
         self.root_service.setServiceParent(self.application)
 
@@ -0,0 +1,1285 @@
+"""
+
+MHub Event Bus Module
+
+.. module:: bus
+   :platform: Unix
+   :synopsis: MHub event bus subscription and dispatch helpers
+
+.. moduleauthor:: JingleManSweep <jinglemansweep@gmail.com>
+
+"""
+
+import binascii
+import fnmatch
+import itertools
+import json
+import os
+import random
+import re
+import time
+import weakref
+
+from collections import deque, OrderedDict
+from operator import attrgetter
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_BLOCK = "block"
+
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_BLOCK)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+PRIORITIES = {
+    "high": PRIORITY_HIGH,
+    "normal": PRIORITY_NORMAL
+}
+
+NODE_ID = binascii.hexlify(os.urandom(4))
+
+_event_ids = itertools.count(1)
+
+
+def next_event_id():
+
+    """
+    Generate a compact event id, unique across nodes ("<node>-<counter>").
+
+    :returns: str
+    """
+
+    return "%s-%x" % (NODE_ID, next(_event_ids))
+
+WILDCARD_CHARS = "*?["
+
+
+def is_pattern(tag):
+
+    """
+    Test whether a query term is a glob-style wildcard pattern.
+
+    :param tag: Query term, e.g. "n:sensor*" or "c:*".
+    :type tag: str.
+    :returns: bool
+    """
+
+    for char in WILDCARD_CHARS:
+        if char in tag: return True
+
+    return False
+
+
+class Event(object):
+
+    """
+    Immutable published event.
+
+    One Event is built per publish and shared by every subscriber, so network
+    sinks can reuse its encoded forms: the first call to :meth:`encode` for a
+    format caches the bytes and later calls (from other bridges or other
+    WebSocket clients) return the cached copy. Subscribers must not mutate
+    ``detail``.
+
+    :param tags: Normalised event tags.
+    :type tags: tuple.
+    :param detail: Event detail dictionary.
+    :type detail: dict.
+    :param timestamp: Publish time (seconds since the epoch).
+    :type timestamp: float.
+    :param origin: Name of the publishing plugin.
+    :type origin: str.
+    :param priority: Dispatch priority (:data:`PRIORITY_HIGH` or
+                     :data:`PRIORITY_NORMAL`).
+    :type priority: int.
+    :param id: Event id, kept when an event is relayed between nodes.
+    :type id: str.
+    :param hops: Number of bridges the event has crossed.
+    :type hops: int.
+    """
+
+    __slots__ = ("tags", "detail", "timestamp", "origin", "priority", "id",
+                 "hops", "_encoded")
+
+    def __init__(self, tags, detail, timestamp=None, origin=None,
+                 priority=PRIORITY_NORMAL, id=None, hops=0):
+
+        """ Constructor """
+
+        _set = object.__setattr__
+        _set(self, "tags", tags)
+        _set(self, "detail", detail)
+        _set(self, "timestamp", time.time() if timestamp is None else timestamp)
+        _set(self, "origin", origin)
+        _set(self, "priority", priority)
+        _set(self, "id", id or next_event_id())
+        _set(self, "hops", hops)
+        _set(self, "_encoded", dict())
+
+
+    def __setattr__(self, name, value):
+
+        raise AttributeError("Event objects are immutable")
+
+
+    def __reduce__(self):
+
+        return (Event, (self.tags, self.detail, self.timestamp, self.origin,
+                        self.priority, self.id, self.hops))
+
+
+    def __repr__(self):
+
+        return "<Event %s>" % (" ".join(self.tags))
+
+
+    def to_dict(self):
+
+        """
+        Get the event as a plain dictionary.
+
+        :returns: dict
+        """
+
+        return dict(tags=list(self.tags),
+                    detail=self.detail,
+                    timestamp=self.timestamp,
+                    origin=self.origin,
+                    id=self.id,
+                    hops=self.hops)
+
+
+    def encode(self, fmt="json"):
+
+        """
+        Get (and cache) an encoded form of the event.
+
+        :param fmt: Encoding name, one of :data:`EVENT_ENCODERS`.
+        :type fmt: str.
+        :returns: str
+        """
+
+        encoded = self._encoded.get(fmt)
+
+        if encoded is None:
+            encoder = EVENT_ENCODERS.get(fmt)
+            if encoder is None:
+                raise ValueError("Unknown event encoding '%s'" % (fmt))
+            encoded = self._encoded[fmt] = encoder(self)
+
+        return encoded
+
+
+    @property
+    def json(self):
+
+        """
+        JSON encoded event (tags, detail, timestamp and origin).
+        """
+
+        return self.encode("json")
+
+
+    @property
+    def detail_json(self):
+
+        """
+        JSON encoded event detail only.
+        """
+
+        return self.encode("detail_json")
+
+
+def _encode_msgpack(event):
+
+    if msgpack is None:
+        raise ValueError("msgpack encoding requires the msgpack package")
+
+    return msgpack.packb(event.to_dict())
+
+
+EVENT_ENCODERS = {
+    "json": lambda event: str(json.dumps(event.to_dict())),
+    "detail_json": lambda event: str(json.dumps(event.detail)),
+    "msgpack": _encode_msgpack
+}
+
+
+class RecentIds(object):
+
+    """
+    Bounded set of recently seen event ids (oldest forgotten first).
+
+    Bridges use it to drop events they have already forwarded or relayed.
+
+    :param size: Maximum number of ids remembered.
+    :type size: int.
+    """
+
+    def __init__(self, size=10000):
+
+        """ Constructor """
+
+        self.size = size
+        self.ids = OrderedDict()
+
+
+    def add(self, event_id):
+
+        """
+        Remember an id.
+
+        :param event_id: Event id.
+        :type event_id: str.
+        :returns: bool -- False if the id had already been seen.
+        """
+
+        if event_id in self.ids:
+            return False
+
+        self.ids[event_id] = True
+
+        if len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+
+        return True
+
+
+    def __contains__(self, event_id):
+
+        return event_id in self.ids
+
+
+    def __len__(self):
+
+        return len(self.ids)
+
+
+class PatternGroup(object):
+
+    """
+    Compiled wildcard patterns sharing a literal tag prefix (e.g. "n:").
+
+    All patterns in the group are combined into a single regular expression,
+    so a tag matching none of them is rejected with one regex test.
+    """
+
+    def __init__(self):
+
+        """ Constructor """
+
+        self.members = list()
+        self.combined = None
+
+
+    def add(self, pattern_id, pattern):
+
+        """
+        Compile and add a pattern to the group.
+
+        :param pattern_id: Interned pattern id.
+        :type pattern_id: int.
+        :param pattern: Glob-style pattern.
+        :type pattern: str.
+        """
+
+        regex = fnmatch.translate(pattern)
+        self.members.append((pattern_id, re.compile(regex), regex))
+        self.combined = re.compile("|".join("(?:%s)" % (m[2]) for m in self.members))
+
+
+    def match(self, tag):
+
+        """
+        Get the ids of all patterns in the group matching a tag.
+
+        :param tag: Tag string.
+        :type tag: str.
+        :returns: list of int
+        """
+
+        if not self.combined.match(tag):
+            return ()
+
+        return [m[0] for m in self.members if m[1].match(tag)]
+
+
+class TagRegistry(object):
+
+    """
+    Interns tags into small integer ids.
+
+    Only tags named by a subscription are ever interned, so the registry (and
+    the width of every bitmask) is bounded by the subscriptions on the bus
+    rather than by the tags that happen to be published. Tags unknown to the
+    registry cannot contribute to any match and are simply ignored.
+
+    Wildcard patterns are interned like tags and compiled into per-prefix
+    :class:`PatternGroup` objects. A published tag matching a pattern carries
+    the pattern's id as well as its own, so wildcard subscriptions are indexed
+    and matched exactly like literal ones.
+    """
+
+    def __init__(self):
+
+        """ Constructor """
+
+        self.ids = dict()
+        self.tags = list()
+        self.patterns = dict()
+
+
+    @property
+    def generation(self):
+
+        """
+        Changes whenever a new tag is interned (invalidates cached masks).
+        """
+
+        return len(self.tags)
+
+
+    def intern(self, tag):
+
+        """
+        Get (or allocate) the id of a tag.
+
+        :param tag: Tag string.
+        :type tag: str.
+        :returns: int
+        """
+
+        tag_id = self.ids.get(tag)
+
+        if tag_id is None:
+            tag_id = self.ids[tag] = len(self.tags)
+            self.tags.append(tag)
+            if is_pattern(tag):
+                prefix = tag[:2] if not is_pattern(tag[:2]) and tag[1:2] == ":" else ""
+                self.patterns.setdefault(prefix, PatternGroup()).add(tag_id, tag)
+
+        return tag_id
+
+
+    def lookup(self, tags):
+
+        """
+        Get the ids and combined bitmask of the known tags in a tag list.
+
+        :param tags: Tag strings.
+        :type tags: list.
+        :returns: tuple -- (ids, mask)
+        """
+
+        ids = set()
+        patterns = self.patterns
+
+        for tag in tags:
+            tag_id = self.ids.get(tag)
+            if tag_id is not None:
+                ids.add(tag_id)
+            if patterns:
+                for prefix in (tag[:2], ""):
+                    group = patterns.get(prefix)
+                    if group is not None:
+                        ids.update(group.match(tag))
+
+        mask = 0
+
+        for tag_id in ids:
+            mask |= 1 << tag_id
+
+        return tuple(ids), mask
+
+
+class Query(object):
+
+    """
+    Compiled subscription query.
+
+    A query is a conjunction of clauses, each of which is a single term (which
+    must be present), ``NOT term`` or ``NOT (a OR b)`` (none may be present),
+    or an any-of group ``(a OR b OR c)`` (at least one must be present), e.g.
+    ``"c:owfs AND NOT n:self"`` or ``"o:status (n:garage OR n:hall*)"``. The
+    ``AND`` keyword is optional and terms may be wildcard patterns. Lists of
+    tags are treated as plain all-of queries.
+
+    :param all_of: Terms which must all be present.
+    :type all_of: set.
+    :param any_of: Groups of terms, one of each group must be present.
+    :type any_of: list of set
+    :param none_of: Terms which must not be present.
+    :type none_of: set.
+    """
+
+    TOKENS = re.compile(r"\(|\)|[^\s()]+")
+
+    def __init__(self, all_of=None, any_of=None, none_of=None):
+
+        """ Constructor """
+
+        self.all_of = set(all_of or ())
+        self.any_of = [set(group) for group in any_of or ()]
+        self.none_of = set(none_of or ())
+
+
+    @classmethod
+    def parse(cls, query, name=None):
+
+        """
+        Build a query from a query string or a list of tags.
+
+        :param query: Query string, list of tags or None (match everything).
+        :type query: str.
+        :param name: Subscribing plugin name, substituted for "n:self".
+        :type name: str.
+        :returns: Query
+        """
+
+        if query is None:
+            query = list()
+        elif isinstance(query, Query):
+            return query
+
+        if not isinstance(query, basestring):
+            return cls(all_of=[cls._term(t, name) for t in query])
+
+        parsed = cls()
+        tokens = cls.TOKENS.findall(query)
+        position = 0
+
+        while position < len(tokens):
+
+            token = tokens[position]
+            position += 1
+
+            if token == "AND":
+                continue
+
+            negate = (token == "NOT")
+            if negate:
+                if position >= len(tokens):
+                    raise ValueError("Query '%s' ends with NOT" % (query))
+                token = tokens[position]
+                position += 1
+
+            if token == "(":
+                group = set()
+                while True:
+                    if position >= len(tokens):
+                        raise ValueError("Unbalanced parentheses in query '%s'" % (query))
+                    token = tokens[position]
+                    position += 1
+                    if token == ")": break
+                    if token == "OR": continue
+                    if token in ("AND", "NOT", "("):
+                        raise ValueError("Only OR is allowed inside parentheses in query '%s'" % (query))
+                    group.add(cls._term(token, name))
+                if negate:
+                    parsed.none_of.update(group)
+                else:
+                    parsed.any_of.append(group)
+            elif token in ("OR", ")"):
+                raise ValueError("Unexpected '%s' in query '%s' (group OR terms in parentheses)" % (token, query))
+            elif negate:
+                parsed.none_of.add(cls._term(token, name))
+            else:
+                parsed.all_of.add(cls._term(token, name))
+
+        return parsed
+
+
+    @staticmethod
+    def _term(term, name):
+
+        if term == "n:self" and name is not None:
+            return "n:%s" % (name)
+
+        return term
+
+
+    def __str__(self):
+
+        clauses = sorted(self.all_of)
+        clauses += ["(%s)" % (" OR ".join(sorted(g))) for g in self.any_of]
+        clauses += ["NOT %s" % (t) for t in sorted(self.none_of)]
+
+        return " AND ".join(clauses)
+
+
+class WeakMethod(object):
+
+    """
+    Callable holding a bound method (or function) through a weak reference.
+
+    Calling it after the referent has been garbage collected does nothing.
+
+    :param func: Bound method or function.
+    :type func: function.
+    :param callback: Called with the weak reference once the referent dies.
+    :type callback: function.
+    """
+
+    def __init__(self, func, callback=None):
+
+        """ Constructor """
+
+        owner = getattr(func, "im_self", None)
+
+        if owner is None:
+            self.func = None
+            self.ref = weakref.ref(func, callback)
+        else:
+            self.func = func.im_func
+            self.ref = weakref.ref(owner, callback)
+
+        self.__name__ = func.__name__
+
+
+    @property
+    def im_self(self):
+
+        """
+        Bound object, or None if collected (or not a method).
+        """
+
+        return self.ref() if self.func is not None else None
+
+
+    @property
+    def alive(self):
+
+        """
+        Whether the referent still exists.
+        """
+
+        return self.ref() is not None
+
+
+    def __call__(self, *args):
+
+        obj = self.ref()
+
+        if obj is None:
+            return None
+        elif self.func is None:
+            return obj(*args)
+        else:
+            return self.func(obj, *args)
+
+
+class Subscription(object):
+
+    """
+    Single event subscription held by the service.
+
+    :param func: Callback function.
+    :type func: function.
+    :param query: Compiled query.
+    :type query: Query.
+    :param seq: Subscription sequence number (delivery order).
+    :type seq: int.
+    :param queue: Dispatch queue, or None for synchronous delivery.
+    :type queue: DispatchQueue.
+    :param batch: Deliver a list of events per callback.
+    :type batch: bool.
+    :param event: Deliver :class:`Event` objects rather than (tags, detail).
+    :type event: bool.
+    :param pool: Thread pool to run the callback in, or None for the reactor.
+    :type pool: twisted.python.threadpool.ThreadPool.
+    :param workers: Process pool to run the callback in (``func`` is then a
+                    "module:function" path).
+    :type workers: workers.ProcessPool.
+    """
+
+    def __init__(self, func, query, seq=0, queue=None, batch=False,
+                 event=False, pool=None, workers=None):
+
+        """ Constructor """
+
+        self.func = func
+        self.query = query
+        self.seq = seq
+        self.queue = queue
+        self.batch = batch
+        self.event = event
+        self.pool = pool
+        self.workers = workers
+        self.plugin = None
+        self.ids = ()
+        self.mask = 0
+        self.exclude = 0
+        self.any_masks = ()
+        self.simple = True
+        self.keys = ()
+        self.active = True
+        self.canceller = None
+
+
+    def cancel(self):
+
+        """
+        Remove this subscription from the bus. Cancelling twice is harmless.
+        """
+
+        if self.active and self.canceller is not None:
+            self.canceller(self)
+
+
+    def matches(self, mask):
+
+        """
+        Test whether an event's tag bitmask satisfies this subscription.
+
+        :param mask: Event tag bitmask.
+        :type mask: int.
+        :returns: bool
+        """
+
+        if (mask & self.mask) != self.mask or mask & self.exclude:
+            return False
+
+        for any_mask in self.any_masks:
+            if not mask & any_mask:
+                return False
+
+        return True
+
+
+class SubscriptionIndex(object):
+
+    """
+    Inverted index of subscriptions keyed by interned tag id.
+
+    Each subscription is filed under one required tag of its query, so an event
+    only has to test the subscriptions filed under one of its own tags rather
+    than every subscription on the bus. Subscriptions with only any-of groups
+    are filed under every tag of their smallest group, and subscriptions with
+    no positive terms at all (e.g. only NOT clauses) are kept in a separate
+    list tested against every event.
+    """
+
+    def __init__(self):
+
+        """ Constructor """
+
+        self.registry = TagRegistry()
+        self.by_tag = dict()
+        self.catch_all = list()
+        self.count = 0
+
+
+    def add(self, subscription):
+
+        """
+        Add a subscription to the index, interning its query tags.
+
+        :param subscription: Subscription to index.
+        :type subscription: Subscription.
+        """
+
+        query = subscription.query
+        intern = self.registry.intern
+
+        ids = tuple(intern(tag) for tag in sorted(query.all_of))
+        subscription.ids = ids
+        subscription.mask = self._mask(ids)
+        subscription.exclude = self._mask(intern(tag) for tag in query.none_of)
+        groups = [tuple(intern(tag) for tag in sorted(group)) for group in query.any_of]
+        subscription.any_masks = tuple(self._mask(group) for group in groups)
+        subscription.simple = not (subscription.exclude or subscription.any_masks)
+
+        if ids:
+            key = min(ids, key=lambda i: len(self.by_tag.get(i, ())))
+            subscription.keys = (key,)
+        elif groups:
+            subscription.keys = min(groups, key=len)
+        else:
+            subscription.keys = ()
+
+        for key in subscription.keys:
+            self.by_tag.setdefault(key, list()).append(subscription)
+
+        if not subscription.keys:
+            self.catch_all.append(subscription)
+
+        self.count += 1
+
+
+    def remove(self, subscription):
+
+        """
+        Remove a subscription from the index.
+
+        :param subscription: Subscription to remove.
+        :type subscription: Subscription.
+        """
+
+        if subscription.keys:
+            for key in subscription.keys:
+                bucket = self.by_tag.get(key, ())
+                if subscription in bucket:
+                    bucket.remove(subscription)
+                if not bucket:
+                    self.by_tag.pop(key, None)
+        elif subscription in self.catch_all:
+            self.catch_all.remove(subscription)
+
+        self.count -= 1
+
+
+    def match(self, ids, mask):
+
+        """
+        Find all subscriptions matching an event, in subscription order.
+
+        :param ids: Known tag ids of the event (see :meth:`TagRegistry.lookup`).
+        :type ids: tuple.
+        :param mask: Event tag bitmask.
+        :type mask: int.
+        :returns: list of Subscription
+        """
+
+        matches = [s for s in self.catch_all if s.simple or s.matches(mask)]
+        by_tag = self.by_tag
+        multi = None
+
+        for tag_id in ids:
+            bucket = by_tag.get(tag_id)
+            if bucket is None: continue
+            for subscription in bucket:
+                if subscription.simple:
+                    if (mask & subscription.mask) == subscription.mask:
+                        matches.append(subscription)
+                elif subscription.matches(mask):
+                    if len(subscription.keys) > 1:
+                        if multi is None: multi = set()
+                        if subscription in multi: continue
+                        multi.add(subscription)
+                    matches.append(subscription)
+
+        if len(matches) > 1:
+            matches.sort(key=attrgetter("seq"))
+
+        return matches
+
+
+    def _mask(self, ids):
+
+        mask = 0
+
+        for tag_id in ids:
+            mask |= 1 << tag_id
+
+        return mask
+
+
+class DispatchQueue(object):
+
+    """
+    Bounded queue of pending events for a single subscription.
+
+    Events are drained cooperatively on the reactor, at most ``batch`` per
+    reactor iteration, so a slow subscriber never runs inside the publisher's
+    stack. High priority events wait in a separate lane which is always
+    drained first, so control events overtake any backlog of bulk traffic.
+    When the queue is full the overflow policy decides what happens:
+
+    * ``drop_oldest`` discards the oldest pending event.
+    * ``drop_newest`` discards the event being published.
+    * ``block`` delivers the oldest pending event immediately, making the
+      publisher pay for the subscriber before it can continue.
+
+    Overflow always evicts bulk events before high priority ones.
+
+    :param deliver: Callable invoked with each queued item.
+    :type deliver: function.
+    :param reactor: Twisted Reactor object
+    :type reactor: twisted.internet.reactor
+    :param size: Maximum number of pending events (both lanes).
+    :type size: int.
+    :param overflow: Overflow policy.
+    :type overflow: str.
+    :param batch: Maximum events delivered per reactor iteration.
+    :type batch: int.
+    """
+
+    def __init__(self, deliver, reactor, size=1000,
+                 overflow=OVERFLOW_DROP_OLDEST, batch=100):
+
+        """ Constructor """
+
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '%s'" % (overflow))
+
+        self.deliver = deliver
+        self.reactor = reactor
+        self.size = max(1, int(size))
+        self.overflow = overflow
+        self.batch = max(1, int(batch))
+        self.high = deque()
+        self.pending = deque()
+        self.dropped = 0
+        self.max_depth = 0
+        self.closed = False
+        self._scheduled = None
+
+
+    @property
+    def depth(self):
+
+        """
+        Number of events waiting to be delivered.
+        """
+
+        return len(self.high) + len(self.pending)
+
+
+    def put(self, item, high=False):
+
+        """
+        Queue an item for delivery, applying the overflow policy if full.
+
+        :param item: Queued item.
+        :param high: Queue in the high priority lane.
+        :type high: bool.
+        :returns: bool -- False if the item was dropped.
+        """
+
+        if self.closed:
+            return False
+
+        if self.depth >= self.size:
+            if self.overflow == OVERFLOW_DROP_NEWEST and not (high and self.pending):
+                self.dropped += 1
+                return False
+            elif self.overflow == OVERFLOW_BLOCK:
+                self.deliver(self._pop())
+                if self.closed: return False
+            else:
+                (self.pending or self.high).popleft()
+                self.dropped += 1
+
+        if high:
+            self.high.append(item)
+        else:
+            self.pending.append(item)
+
+        self.max_depth = max(self.max_depth, self.depth)
+        self._schedule()
+
+        return True
+
+
+    def drain(self):
+
+        """
+        Deliver up to ``batch`` pending items, rescheduling if more remain.
+
+        A delivery may close the queue (e.g. a subscriber cancelling itself),
+        so the queue is checked again before each item.
+        """
+
+        self._scheduled = None
+
+        for _ in xrange(self.batch):
+            if not self.depth: break
+            self.deliver(self._pop())
+
+        if self.depth:
+            self._schedule()
+
+
+    def close(self):
+
+        """
+        Discard pending items and stop draining.
+        """
+
+        self.closed = True
+        self.high.clear()
+        self.pending.clear()
+
+        if self._scheduled is not None and self._scheduled.active():
+            self._scheduled.cancel()
+
+        self._scheduled = None
+
+
+    def stats(self):
+
+        """
+        Queue statistics.
+
+        :returns: dict
+        """
+
+        return dict(depth=self.depth,
+                    high=len(self.high),
+                    max_depth=self.max_depth,
+                    size=self.size,
+                    overflow=self.overflow,
+                    dropped=self.dropped)
+
+
+    def _pop(self):
+
+        """
+        Take the next item, serving the high priority lane first.
+        """
+
+        if self.high:
+            return self.high.popleft()
+
+        return self.pending.popleft()
+
+
+    def _schedule(self):
+
+        """
+        Arrange for the queue to be drained on the next reactor iteration.
+        """
+
+        if self._scheduled is None:
+            self._scheduled = self.reactor.callLater(0, self.drain)
+
+
+class CoalesceRule(object):
+
+    """
+    Coalescing rule for events carrying a set of tags.
+
+    :param key: Space separated tags identifying the events, e.g.
+                "c:owfs n:garage".
+    :type key: str.
+    :param window: Window length in seconds.
+    :type window: float.
+    :param mode: "latest" to emit the latest event once per window, or
+                 "debounce" to emit the trailing event of a burst once no
+                 new event has arrived for a whole window.
+    :type mode: str.
+    """
+
+    def __init__(self, key, window=1.0, mode="latest"):
+
+        """ Constructor """
+
+        if mode not in ("latest", "debounce"):
+            raise ValueError("Unknown coalesce mode '%s'" % (mode))
+
+        self.key = key
+        self.tags = frozenset(key.split())
+        self.window = float(window)
+        self.mode = mode
+        self.held = None
+        self.timer = None
+        self.received = 0
+        self.absorbed = 0
+        self.emitted = 0
+
+
+    def stats(self):
+
+        """
+        Rule counters.
+
+        :returns: dict
+        """
+
+        return dict(key=self.key,
+                    mode=self.mode,
+                    window=self.window,
+                    received=self.received,
+                    absorbed=self.absorbed,
+                    emitted=self.emitted,
+                    pending=self.held is not None)
+
+
+class Coalescer(object):
+
+    """
+    Coalescing and debounce stage in front of event dispatch.
+
+    Events matching a rule are held rather than dispatched; while held, newer
+    events for the same rule replace the held one (and are counted as
+    absorbed). The held event is handed to ``emit`` when its window closes.
+    Rule lookups are cached per distinct tag tuple.
+
+    :param reactor: Twisted Reactor object
+    :type reactor: twisted.internet.reactor
+    :param rules: Coalescing rules.
+    :type rules: list of CoalesceRule
+    :param emit: Called with each event released by a rule.
+    :type emit: function.
+    """
+
+    def __init__(self, reactor, rules, emit):
+
+        """ Constructor """
+
+        self.reactor = reactor
+        self.rules = rules
+        self.emit = emit
+        self._cache = dict()
+
+
+    def rule_for(self, tags):
+
+        """
+        Get the first rule matching a tag tuple, if any.
+
+        :param tags: Normalised event tags.
+        :type tags: tuple.
+        :returns: CoalesceRule or None
+        """
+
+        try:
+            return self._cache[tags]
+        except KeyError:
+            pass
+
+        if len(self._cache) >= 4096:
+            self._cache.clear()
+
+        tag_set = frozenset(tags)
+        rule = None
+
+        for candidate in self.rules:
+            if candidate.tags.issubset(tag_set):
+                rule = candidate
+                break
+
+        self._cache[tags] = rule
+
+        return rule
+
+
+    def offer(self, event):
+
+        """
+        Offer an event to the coalescing stage.
+
+        :param event: Published event.
+        :type event: Event.
+        :returns: bool -- True if the event was taken (held or absorbed).
+        """
+
+        rule = self.rule_for(event.tags)
+
+        if rule is None:
+            return False
+
+        rule.received += 1
+
+        if rule.held is not None:
+            rule.absorbed += 1
+
+        rule.held = event
+
+        if rule.timer is None:
+            rule.timer = self.reactor.callLater(rule.window, self._release, rule)
+        elif rule.mode == "debounce":
+            rule.timer.reset(rule.window)
+
+        return True
+
+
+    def flush(self):
+
+        """
+        Release all held events immediately.
+        """
+
+        for rule in self.rules:
+            if rule.timer is not None and rule.timer.active():
+                rule.timer.cancel()
+            if rule.held is not None:
+                self._release(rule)
+
+
+    def stats(self):
+
+        """
+        Per-rule counters.
+
+        :returns: list of dict
+        """
+
+        return [rule.stats() for rule in self.rules]
+
+
+    def _release(self, rule):
+
+        event, rule.held, rule.timer = rule.held, None, None
+
+        if event is not None:
+            rule.emitted += 1
+            self.emit(event)
+
+
+class LimitRule(object):
+
+    """
+    Rate limit and/or sampling rule for events matching a tag query.
+
+    :param match: Space separated query terms (wildcards allowed), e.g.
+                  "c:byebyestandby" or "c:telnet u:*".
+    :type match: str.
+    :param rate: Sustained events per second allowed per source.
+    :type rate: float.
+    :param burst: Token bucket size (defaults to ``rate``).
+    :type burst: float.
+    :param sample: Fraction of (rate limited) events to let through.
+    :type sample: float.
+    """
+
+    def __init__(self, match, rate=None, burst=None, sample=None):
+
+        """ Constructor """
+
+        self.match = match
+        self.terms = [re.compile(fnmatch.translate(term)) for term in match.split()]
+        self.rate = float(rate) if rate is not None else None
+        self.burst = float(burst if burst is not None else rate or 1)
+        self.sample = float(sample) if sample is not None else None
+        self.buckets = dict()
+
+
+    def matches(self, tags):
+
+        """
+        Test whether every term of the rule matches one of the tags.
+
+        :param tags: Normalised event tags.
+        :type tags: tuple.
+        :returns: bool
+        """
+
+        for term in self.terms:
+            for tag in tags:
+                if term.match(tag): break
+            else:
+                return False
+
+        return True
+
+
+    def take(self, source, now):
+
+        """
+        Take a token from a source's bucket.
+
+        :param source: Source (publishing plugin) name.
+        :type source: str.
+        :param now: Current time in seconds.
+        :type now: float.
+        :returns: bool -- False if the bucket is empty.
+        """
+
+        if self.rate is None:
+            return True
+
+        bucket = self.buckets.get(source)
+
+        if bucket is None:
+            bucket = self.buckets[source] = [self.burst, now]
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+        if tokens < 1.0:
+            bucket[0] = tokens
+            return False
+
+        bucket[0] = tokens - 1.0
+
+        return True
+
+
+class RateLimiter(object):
+
+    """
+    Per-source token bucket rate limiting and sampling stage for publish.
+
+    The first rule matching an event's tags applies; each publishing plugin
+    gets its own token bucket per rule. Rule lookups are cached per distinct
+    tag tuple, so wildcard terms are only evaluated once per tag set.
+
+    :param rules: Limit rules.
+    :type rules: list of LimitRule
+    :param clock: Callable returning the current time in seconds.
+    :type clock: function.
+    """
+
+    def __init__(self, rules, clock=time.time):
+
+        """ Constructor """
+
+        self.rules = rules
+        self.clock = clock
+        self.counters = dict()
+        self._cache = dict()
+
+
+    def allow(self, tags, source):
+
+        """
+        Decide whether an event may be published.
+
+        :param tags: Normalised event tags.
+        :type tags: tuple.
+        :param source: Source (publishing plugin) name.
+        :type source: str.
+        :returns: bool
+        """
+
+        try:
+            rule = self._cache[tags]
+        except KeyError:
+            if len(self._cache) >= 4096:
+                self._cache.clear()
+            rule = None
+            for candidate in self.rules:
+                if candidate.matches(tags):
+                    rule = candidate
+                    break
+            self._cache[tags] = rule
+
+        if rule is None:
+            return True
+
+        counters = self.counters.get(source)
+
+        if counters is None:
+            counters = self.counters[source] = dict(passed=0, dropped=0, sampled=0)
+
+        if not rule.take(source, self.clock()):
+            counters["dropped"] += 1
+            return False
+
+        if rule.sample is not None and random.random() >= rule.sample:
+            counters["sampled"] += 1
+            return False
+
+        counters["passed"] += 1
+
+        return True
+
+
+    def stats(self):
+
+        """
+        Passed, dropped (rate limited) and sampled out counts per source.
+
+        :returns: dict
+        """
+
+        return dict((source, dict(counters)) for source, counters in self.counters.iteritems())
+
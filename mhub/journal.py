@@ -0,0 +1,502 @@
+"""
+
+MHub Event Journal Module
+
+.. module:: journal
+   :platform: Unix
+   :synopsis: MHub append-only event journal and replay
+
+.. moduleauthor:: JingleManSweep <jinglemansweep@gmail.com>
+
+"""
+
+import bisect
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+MAGIC = "MHJ1"
+
+SEGMENT_HEADER = struct.Struct("!4s12s")
+
+FRAME = struct.Struct("!Id")
+
+INDEX_ENTRY = struct.Struct("!dQ")
+
+REPLAY_ORIGIN = "journal"
+
+DECODERS = {
+    "json": json.loads,
+    "msgpack": lambda data: msgpack.unpackb(data)
+}
+
+
+def segment_paths(path):
+
+    """
+    List a journal's segment files, oldest first.
+
+    :param path: Journal directory.
+    :type path: str.
+    :returns: list
+    """
+
+    return sorted(glob.glob(os.path.join(path, "*.seg")))
+
+
+class Journal(object):
+
+    """
+    Append-only journal of published events.
+
+    Events are recorded by reference on the reactor thread and written in
+    batches by a dedicated writer thread, so recording costs publish no more
+    than a list append. Each event is framed as its payload length, timestamp
+    and encoded form (see :meth:`bus.Event.encode`) in numbered segment files
+    of up to ``segment_size`` bytes. Alongside each segment, an ``.idx`` file
+    maps timestamps to frame offsets, one entry per ``index_interval``
+    seconds, so readers can seek to a time without scanning.
+
+    :param reactor: Twisted Reactor object
+    :type reactor: twisted.internet.reactor
+    :param path: Journal directory.
+    :type path: str.
+    :param segment_size: Bytes per segment before rotating.
+    :type segment_size: int.
+    :param segments: Number of segments kept (0 keeps all).
+    :type segments: int.
+    :param flush_interval: Seconds between batched writes.
+    :type flush_interval: float.
+    :param index_interval: Seconds between time index entries.
+    :type index_interval: float.
+    :param fmt: Event encoding, "json" or "msgpack".
+    :type fmt: str.
+    """
+
+    def __init__(self, reactor, path, segment_size=64 * 1024 * 1024,
+                 segments=0, flush_interval=0.5, index_interval=1.0,
+                 fmt="json"):
+
+        """ Constructor """
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.reactor = reactor
+        self.path = path
+        self.segment_size = segment_size
+        self.segments = segments
+        self.flush_interval = flush_interval
+        self.index_interval = index_interval
+        self.fmt = fmt
+        self.pending = list()
+        self.timer = None
+        self.segment = None
+        self.index = None
+        self.offset = 0
+        self.last_indexed = None
+        self.recorded = 0
+        self.written = 0
+        self.skipped = 0
+        self.rotations = 0
+        self.writer = ThreadPool(1, 1, "mhub.journal")
+        self.logger = logging.getLogger("journal")
+
+
+    def start(self):
+
+        """
+        Start the writer thread.
+        """
+
+        self.writer.start()
+
+
+    def stop(self):
+
+        """
+        Write pending events, close the current segment and stop the writer.
+        """
+
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+        pending, self.pending = self.pending, list()
+        self.writer.stop()
+        self.write(pending)
+        self.close_segment()
+
+
+    def record(self, event):
+
+        """
+        Record a published event (subscription callback).
+
+        :param event: Published event.
+        :type event: bus.Event.
+        """
+
+        if event.origin == REPLAY_ORIGIN: return
+
+        self.pending.append(event)
+        self.recorded += 1
+
+        if self.timer is None:
+            self.timer = self.reactor.callLater(self.flush_interval, self.flush)
+
+
+    def flush(self):
+
+        """
+        Hand recorded events to the writer thread.
+
+        :returns: Deferred firing once they are written.
+        """
+
+        self.timer = None
+        pending, self.pending = self.pending, list()
+
+        d = threads.deferToThreadPool(self.reactor, self.writer, self.write, pending)
+        d.addErrback(self._write_failed)
+
+        return d
+
+
+    def write(self, events):
+
+        """
+        Encode and append events to the current segment (writer thread).
+
+        Events that cannot be encoded are logged and skipped.
+
+        :param events: Events to write.
+        :type events: list.
+        """
+
+        if not events: return
+
+        fmt = self.fmt
+        pack = FRAME.pack
+        chunks = list()
+        size = 0
+        written = 0
+
+        for event in events:
+
+            try:
+                payload = event.encode(fmt)
+            except Exception, e:
+                self.skipped += 1
+                self.logger.warn("Cannot journal event %s %s: %s" % (event.id, list(event.tags), e))
+                continue
+
+            if self.segment is None or self.offset + size >= self.segment_size:
+                self._append(chunks)
+                chunks, size = list(), 0
+                self.open_segment()
+
+            timestamp = event.timestamp
+
+            if self.last_indexed is None or timestamp - self.last_indexed >= self.index_interval:
+                self._append(chunks)
+                chunks, size = list(), 0
+                self.index.write(INDEX_ENTRY.pack(timestamp, self.offset))
+                self.last_indexed = timestamp
+
+            chunks.append(pack(len(payload), timestamp))
+            chunks.append(payload)
+            size += FRAME.size + len(payload)
+            written += 1
+
+        if not written: return
+
+        self._append(chunks)
+        self.segment.flush()
+        self.index.flush()
+        self.written += written
+
+
+    def open_segment(self):
+
+        """
+        Close the current segment (if any) and start the next one.
+        """
+
+        self.close_segment()
+
+        paths = segment_paths(self.path)
+        number = int(os.path.basename(paths[-1])[:-4]) + 1 if paths else 0
+        name = os.path.join(self.path, "%010d" % (number))
+
+        self.segment = open(name + ".seg", "ab")
+        self.index = open(name + ".idx", "ab")
+        self.segment.write(SEGMENT_HEADER.pack(MAGIC, self.fmt))
+        self.offset = SEGMENT_HEADER.size
+        self.last_indexed = None
+        self.rotations += 1
+
+        if self.segments:
+            for old in paths[:max(0, len(paths) + 1 - self.segments)]:
+                os.remove(old)
+                if os.path.exists(old[:-4] + ".idx"):
+                    os.remove(old[:-4] + ".idx")
+
+
+    def close_segment(self):
+
+        """
+        Close the current segment.
+        """
+
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+            self.segment = self.index = None
+
+
+    def stats(self):
+
+        """
+        Journal statistics.
+
+        :returns: dict
+        """
+
+        return dict(recorded=self.recorded,
+                    written=self.written,
+                    skipped=self.skipped,
+                    pending=len(self.pending),
+                    segments=len(segment_paths(self.path)),
+                    rotations=self.rotations)
+
+
+    def _append(self, chunks):
+
+        if chunks:
+            data = "".join(chunks)
+            self.segment.write(data)
+            self.offset += len(data)
+
+
+    def _write_failed(self, failure):
+
+        self.logger.error("Failed to write journal: %s" % (failure.getErrorMessage()))
+
+
+class JournalReader(object):
+
+    """
+    Read events back from a journal directory.
+
+    Segments are memory-mapped and their time indexes used to seek to the
+    start of a range, so reading a short range of a large journal is cheap.
+
+    :param path: Journal directory.
+    :type path: str.
+    """
+
+    def __init__(self, path):
+
+        """ Constructor """
+
+        self.path = path
+
+
+    def read(self, start=None, end=None):
+
+        """
+        Iterate over journalled events in a time range.
+
+        :param start: Earliest timestamp (inclusive).
+        :type start: float.
+        :param end: Latest timestamp (exclusive).
+        :type end: float.
+        :returns: iterator of (timestamp, event dictionary) pairs
+        """
+
+        for path in segment_paths(self.path):
+
+            index = self._read_index(path[:-4] + ".idx")
+
+            if end is not None and index and index[0][0] >= end:
+                break
+
+            for item in self._read_segment(path, index, start, end):
+                yield item
+
+
+    def _read_index(self, path):
+
+        if not os.path.exists(path):
+            return list()
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        count = len(data) // INDEX_ENTRY.size
+
+        return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in xrange(count)]
+
+
+    def _read_segment(self, path, index, start, end):
+
+        with open(path, "rb") as f:
+
+            if os.fstat(f.fileno()).st_size <= SEGMENT_HEADER.size:
+                return
+
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                magic, fmt = SEGMENT_HEADER.unpack_from(mm, 0)
+                if magic != MAGIC:
+                    raise ValueError("'%s' is not a journal segment" % (path))
+                decode = DECODERS[fmt.rstrip("\0")]
+
+                offset = SEGMENT_HEADER.size
+                if start is not None and index:
+                    position = bisect.bisect_right([entry[0] for entry in index], start) - 1
+                    if position >= 0:
+                        offset = index[position][1]
+
+                size = len(mm)
+                unpack = FRAME.unpack_from
+
+                while offset + FRAME.size <= size:
+                    length, timestamp = unpack(mm, offset)
+                    payload_end = offset + FRAME.size + length
+                    if payload_end > size: break
+                    if end is not None and timestamp >= end: return
+                    if start is None or timestamp >= start:
+                        yield timestamp, decode(mm[offset + FRAME.size:payload_end])
+                    offset = payload_end
+            finally:
+                mm.close()
+
+
+class ReplaySource(object):
+
+    """
+    Publisher of replayed events (stands in for a plugin).
+    """
+
+    name = REPLAY_ORIGIN
+    cls = "journal"
+    cfg = dict()
+
+
+class Replay(object):
+
+    """
+    Publish journalled events back onto the bus.
+
+    Events are published at their original pace multiplied by ``speed``
+    (``speed=0`` replays as fast as possible), in batches of the events due
+    at each step. Replayed events get new ids but keep their original tags.
+
+    :param reactor: Twisted Reactor object
+    :type reactor: twisted.internet.reactor
+    :param reader: Journal reader.
+    :type reader: JournalReader.
+    :param publish: Called with each batch of (tags, detail) pairs.
+    :type publish: function.
+    :param start: Earliest timestamp (inclusive).
+    :type start: float.
+    :param end: Latest timestamp (exclusive).
+    :type end: float.
+    :param speed: Playback speed multiplier.
+    :type speed: float.
+    :param batch: Maximum events published per step.
+    :type batch: int.
+    """
+
+    def __init__(self, reactor, reader, publish, start=None, end=None,
+                 speed=1.0, batch=1000):
+
+        """ Constructor """
+
+        self.reactor = reactor
+        self.events = reader.read(start, end)
+        self.publish = publish
+        self.speed = speed
+        self.batch = batch
+        self.next = None
+        self.origin = None
+        self.started = None
+        self.replayed = 0
+        self.timer = None
+        self.done = False
+
+
+    def start(self):
+
+        """
+        Start replaying.
+        """
+
+        self.started = self.reactor.seconds()
+        self.next = next(self.events, None)
+
+        if self.next is not None:
+            self.origin = self.next[0]
+
+        self._step()
+
+
+    def stop(self):
+
+        """
+        Stop replaying.
+        """
+
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+
+        self.timer = None
+        self.done = True
+
+
+    def _step(self):
+
+        self.timer = None
+
+        if self.speed:
+            due = self.origin + (self.reactor.seconds() - self.started) * self.speed
+        else:
+            due = None
+
+        batch = list()
+
+        while self.next is not None and len(batch) < self.batch:
+            timestamp, record = self.next
+            if due is not None and timestamp > due: break
+            batch.append((record["tags"], record["detail"]))
+            self.next = next(self.events, None)
+
+        if batch:
+            self.publish(batch)
+            self.replayed += len(batch)
+
+        if self.next is None:
+            self.done = True
+            return
+
+        if due is None or len(batch) >= self.batch:
+            delay = 0
+        else:
+            delay = (self.next[0] - due) / self.speed
+
+        self.timer = self.reactor.callLater(delay, self._step)
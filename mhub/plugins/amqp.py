@@ -27,6 +27,7 @@ import os
 import json
 
 from base import BasePlugin
+from bus import Event
 
 
 class AmqpPlugin(BasePlugin):
@@ -57,11 +58,16 @@ class AmqpPlugin(BasePlugin):
         """
         Send an AMQP message to the broker.
 
-        :param msg: Message dictionary.
+        :param msg: Message dictionary or event (sent using its cached JSON).
         :type msg: dict.
         """
 
-        json_msg = json.dumps(msg)
+        if isinstance(msg, Event):
+            if not self.forward_event(msg): return
+            json_msg = msg.json
+        else:
+            json_msg = json.dumps(msg)
+
         self.factory.send_message(msg=json_msg)
 
 
@@ -74,7 +80,15 @@ class AmqpPlugin(BasePlugin):
         :type msg: dict.
         """
 
-        self.publish(["o:receive"], msg)
+        try:
+            envelope = json.loads(msg.content.body)
+        except (AttributeError, ValueError):
+            envelope = None
+
+        if isinstance(envelope, dict) and "id" in envelope:
+            self.receive_event(envelope, ["o:receive"])
+        else:
+            self.publish(["o:receive"], msg)
 
 
 
@@ -2,7 +2,10 @@ import json
 import logging
 import os
 import sys
-from pymongo import Connection
+from twisted.internet import defer, reactor
+from twisted.python.threadable import isInIOThread
+
+from bus import RecentIds
 
 
 class BasePlugin(object):
@@ -27,12 +30,13 @@ class BasePlugin(object):
             os.makedirs(plugin_cache_dir)
 
         self.cache_dir = plugin_cache_dir
-        self.db_set(self.service.cache, "_config", self.cfg)
+        d = self.db_set_async("cache", "_config", self.cfg)
+        d.addErrback(self.service.db_failed, "%s._config" % (self.name))
 
         self.subscribe(self.reconfigure, ["c:mhub", "i:reconfigure"])
 
 
-    def subscribe(self, func, query=None):
+    def subscribe(self, func, query=None, **kwargs):
 
         """
         Create a subscription to an event
@@ -41,12 +45,14 @@ class BasePlugin(object):
         :type func: function.
         :param query: Event query.
         :type query: dict.
+        :param kwargs: Dispatch options (see :meth:`BaseService.subscribe`).
+        :returns: Subscription handle.
         """
 
-        self.service.subscribe(func, query)
+        return self.service.subscribe(func, query, plugin=self, **kwargs)
 
 
-    def publish(self, query, detail=None, raw=False):
+    def publish(self, query, detail=None, raw=False, event_id=None, hops=0):
 
         """
         Publish (send) event to service.
@@ -55,21 +61,136 @@ class BasePlugin(object):
         :type query: dict.
         :param detail: Detail dictionary.
         :type detail: dict.
+        :param event_id: Id of an event relayed from another node.
+        :type event_id: str.
+        :param hops: Number of bridges a relayed event has crossed.
+        :type hops: int.
+        """
+
+        if not isInIOThread():
+            reactor.callFromThread(self.service.publish, query, detail, self,
+                                   event_id, hops)
+            return
+
+        self.service.publish(query, detail, self, event_id, hops)
+
+
+    def publish_many(self, events):
+
+        """
+        Publish (send) a batch of events to service.
+
+        :param events: Sequence of (tags, detail) pairs.
+        :type events: list.
+        """
+
+        if not isInIOThread():
+            reactor.callFromThread(self.service.publish_many, events, self)
+            return
+
+        self.service.publish_many(events, self)
+
+
+    def forward_event(self, event):
+
+        """
+        Check whether a bridge should forward an event to its remote side.
+
+        Events the bridge has already forwarded, or has itself relayed onto
+        the bus from the remote side, are rejected so that events cannot bounce
+        between bridges and nodes.
+
+        :param event: Event about to be forwarded.
+        :type event: bus.Event.
+        :returns: bool
+        """
+
+        return self.recent_ids.add(event.id)
+
+
+    def receive_event(self, envelope, tags=None):
+
+        """
+        Relay an event envelope received by a bridge onto the bus.
+
+        The remote event's id is kept and its hop count incremented; envelopes
+        already seen by this bridge are dropped.
+
+        :param envelope: Decoded event envelope (see :meth:`bus.Event.to_dict`).
+        :type envelope: dict.
+        :param tags: Tags to use if the envelope carries none.
+        :type tags: list.
+        :returns: bool -- False if the envelope was dropped.
+        """
+
+        event_id = envelope.get("id")
+
+        if event_id is not None and not self.recent_ids.add(event_id):
+            return False
+
+        self.publish(envelope.get("tags") or tags,
+                     envelope.get("detail"),
+                     event_id=event_id,
+                     hops=envelope.get("hops", 0) + 1)
+
+        return True
+
+
+    @property
+    def recent_ids(self):
+
+        """
+        Bounded cache of event ids this plugin has forwarded or relayed.
         """
 
-        self.service.publish(query, detail, self)
+        recent = self.__dict__.get("_recent_ids")
+
+        if recent is None:
+            size = getattr(self, "cfg", dict()).get("recent_ids", 10000)
+            recent = self.__dict__["_recent_ids"] = RecentIds(size)
 
+        return recent
 
-    def reconfigure(self):
+
+    def run_in_worker(self, path, *args):
 
         """
-        Retrieves plugins operating configuration
+        Run a CPU-bound function in the service's worker process pool.
+
+        :param path: Function path, e.g. "plugins.http:find_patterns".
+        :type path: str.
+        :returns: Deferred firing with the function's return value.
+        """
+
+        return self.service.process_pool().call(path, *args)
+
+
+    def reconfigure(self, tags=None, detail=None):
 
-        :param cfg: Configuration object.
+        """
+        Retrieves plugins operating configuration (as stored by :meth:`setup`).
+
+        :param tags: Event tags.
+        :type tags: tuple.
+        :param detail: Event detail.
+        :type detail: dict.
+        :returns: Deferred firing with the configuration.
         """
 
         self.logger.debug("Reconfiguring plugin '%s'" % (self.name))
-        self.cfg = self.db_get(self.state, "!config", self.default_config)
+
+        d = self.db_get_async("cache", "_config", self.cfg)
+        d.addCallback(self._reconfigured)
+        d.addErrback(self.service.db_failed, "%s._config" % (self.name))
+
+        return d
+
+
+    def _reconfigured(self, cfg):
+
+        self.cfg = cfg
+
+        return cfg
 
 
     def db_get(self, collection, name, default, scope="plugin"):
@@ -82,13 +203,14 @@ class BasePlugin(object):
         return self.service.db_get(collection, db_name, default, scope)
 
 
-    def db_find(self, collection, query, scope="plugin"):
+    def db_find(self, collection, query, scope="plugin", **kwargs):
 
         """
-        Retrieve value from configured database connection
+        Retrieve value from configured database connection (see
+        :meth:`service.BaseService.db_find` for paging options)
         """
 
-        return self.service.db_find(collection, query, scope)
+        return self.service.db_find(collection, query, scope, **kwargs)
 
 
     def db_set(self, collection, name, value, scope="plugin"):
@@ -101,3 +223,170 @@ class BasePlugin(object):
         self.service.db_set(collection, db_name, value, scope)
 
 
+    def load_recent(self, name, recent):
+
+        """
+        Restore a persisted :class:`store.RecentSet` from the cache.
+
+        :param name: Record name prefix.
+        :type name: str.
+        :param recent: Set to restore into.
+        :type recent: store.RecentSet.
+        :returns: Deferred firing with the set.
+        """
+
+        names = dict(("%s.%i" % (name, slot), slot) for slot in xrange(recent.generations))
+
+        def _restore(values):
+            recent.restore(dict((names[key], state) for key, state in values.iteritems()))
+            return recent
+
+        d = self.db_get_many_async("cache", names.keys())
+        d.addCallback(_restore)
+        d.addErrback(self.service.db_failed, "%s.%s" % (self.name, name))
+
+        return d
+
+
+    def save_recent(self, name, recent):
+
+        """
+        Persist the slots of a :class:`store.RecentSet` changed since it was
+        last saved.
+
+        :param name: Record name prefix.
+        :type name: str.
+        :param recent: Set to save.
+        :type recent: store.RecentSet.
+        :returns: Deferred firing once the changes are written.
+        """
+
+        changes = recent.changes()
+
+        if not changes:
+            return defer.succeed(None)
+
+        d = self.db_set_many_async("cache", dict(("%s.%i" % (name, slot), state)
+                                                 for slot, state in changes.iteritems()))
+        d.addErrback(self.service.db_failed, "%s.%s" % (self.name, name))
+
+        return d
+
+
+    def db_index(self, collection, field):
+
+        """
+        Declare an index on a record field this plugin queries by.
+
+        :param collection: Collection name ("store" or "cache").
+        :type collection: str.
+        :param field: Field name.
+        :type field: str.
+        """
+
+        self.service.db_ensure_index(collection, field)
+
+
+    def db_get_many(self, collection, names, default=None, scope="plugin"):
+
+        """
+        Retrieve several values from configured database connection in one
+        query.
+
+        :param names: Record names.
+        :type names: list.
+        :returns: dict -- values by name.
+        """
+
+        db_names = dict(("%s.%s" % (self.name, name), name) for name in names)
+        values = self.service.db_get_many(collection, db_names.keys(), default, scope)
+
+        return dict((db_names[db_name], value) for db_name, value in values.iteritems())
+
+
+    def db_set_many(self, collection, values, scope="plugin"):
+
+        """
+        Store several values in configured database connection in one bulk
+        write.
+
+        :param values: Values by record name.
+        :type values: dict.
+        """
+
+        self.service.db_set_many(collection,
+                                 dict(("%s.%s" % (self.name, name), value)
+                                      for name, value in values.iteritems()),
+                                 scope)
+
+
+    def db_get_async(self, collection, name, default, scope="plugin"):
+
+        """
+        Retrieve value from configured database connection without blocking
+        the reactor.
+
+        :returns: Deferred firing with the value.
+        """
+
+        db_name = "%s.%s" % (self.name, name)
+        return self.service.db_get_async(collection, db_name, default, scope)
+
+
+    def db_find_async(self, collection, query, scope="plugin", **kwargs):
+
+        """
+        Find records in configured database connection without blocking the
+        reactor.
+
+        :returns: Deferred firing with a list of records.
+        """
+
+        return self.service.db_find_async(collection, query, scope, **kwargs)
+
+
+    def db_get_many_async(self, collection, names, default=None, scope="plugin"):
+
+        """
+        Retrieve several values from configured database connection in one
+        query, without blocking the reactor.
+
+        :returns: Deferred firing with values by name.
+        """
+
+        db_names = dict(("%s.%s" % (self.name, name), name) for name in names)
+        d = self.service.db_get_many_async(collection, db_names.keys(), default, scope)
+        d.addCallback(lambda values: dict((db_names[db_name], value)
+                                          for db_name, value in values.iteritems()))
+
+        return d
+
+
+    def db_set_many_async(self, collection, values, scope="plugin"):
+
+        """
+        Store several values in configured database connection in one bulk
+        write, without blocking the reactor.
+
+        :returns: Deferred firing once the values are written.
+        """
+
+        return self.service.db_set_many_async(collection,
+                                              dict(("%s.%s" % (self.name, name), value)
+                                                   for name, value in values.iteritems()),
+                                              scope)
+
+
+    def db_set_async(self, collection, name, value, scope="plugin"):
+
+        """
+        Store value in configured database connection without blocking the
+        reactor.
+
+        :returns: Deferred firing once the value is written.
+        """
+
+        db_name = "%s.%s" % (self.name, name)
+        return self.service.db_set_async(collection, db_name, value, scope)
+
+
@@ -43,13 +43,14 @@ class ByeByeStandbyPlugin(BasePlugin):
 
         reactor.listenUDP(self.port, self.protocol)
 
-	self.subscribe(self.switch_device, ["c:byebyestandby", "i:switch"])
+        self.subscribe(self.switch_device, ["c:byebyestandby", "i:switch"],
+                       executor="thread")
 
 
     def switch_device(self, tags, detail):
 
         """
-        Device switcher callback.
+        Device switcher callback (runs in the plugin's thread pool).
 
         :param msg: Message dictionary.
         :type msg: dict.
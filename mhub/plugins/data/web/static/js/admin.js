@@ -9,8 +9,8 @@ function setup_event_websocket(url) {
             el, header, signal, name, meta, detail;
         el = $("<div></div>").addClass("event-console-entry");
         header = $("<p></p>").addClass("header");
-        signal = $("<span></span>").addClass("signal").text(data.signal);
-        sender = $("<span></span>").addClass("sender").text(data.sender);
+        signal = $("<span></span>").addClass("signal").text(data.tags);
+        sender = $("<span></span>").addClass("sender").text(data.origin);
         header.append(signal).append(sender);
         detail = $("<p></p>").addClass("detail").text(JSON.stringify(data.detail));
         el.append(header).append(detail);
@@ -5,6 +5,7 @@ from twisted.internet.task import LoopingCall
 from twisted.web.client import getPage
 
 from base import BasePlugin
+from store import RecentSet
 
 
 class HttpPlugin(BasePlugin):
@@ -16,7 +17,9 @@ class HttpPlugin(BasePlugin):
     default_config = {
         "url": "http://en.wikipedia.org",
         "patterns": ["welcome to"],
-        "poll_interval": 60
+        "poll_interval": 60,
+        "workers": False,
+        "dedupe_window": 0
     }
     
 
@@ -32,7 +35,16 @@ class HttpPlugin(BasePlugin):
             return
 
         poll_task = LoopingCall(self.poll_url)
-        poll_task.start(self.cfg.get("poll_interval", 60))
+
+        dedupe_window = self.cfg.get("dedupe_window", 0)
+
+        if dedupe_window:
+            self.seen = RecentSet(dedupe_window)
+            d = self.load_recent("seen", self.seen)
+            d.addBoth(lambda _: poll_task.start(self.cfg.get("poll_interval", 60)))
+        else:
+            self.seen = None
+            poll_task.start(self.cfg.get("poll_interval", 60))
 
 
     def poll_url(self):
@@ -51,15 +63,26 @@ class HttpPlugin(BasePlugin):
         Callback function used to search the retrieved HTML for the configured patterns.
         """
 
-        found = False
-        matches = list()
+        if self.cfg.get("workers", False):
+            self.run_in_worker("plugins.http:find_patterns", body, self.patterns) \
+                .addCallbacks(callback=self.publish_matches,
+                              errback=self.error_response)
+        else:
+            self.publish_matches(find_patterns(body, self.patterns))
+
+
+    def publish_matches(self, matches):
+
+        """
+        Publish the patterns found in the retrieved HTML, if any (only those
+        not already seen within ``dedupe_window`` seconds, if set).
+        """
 
-        for pattern in self.patterns:
-            if pattern.lower() in str(body).lower():
-               found = True
-               matches.append(pattern.lower())
+        if self.seen is not None:
+            matches = [m for m in matches if self.seen.add("%s %s" % (self.url, m))]
+            self.save_recent("seen", self.seen)
 
-        if found:                  
+        if matches:
             detail = dict(url=self.url,
                           matches=matches)
             self.publish(["o:match"], detail)
@@ -74,6 +97,18 @@ class HttpPlugin(BasePlugin):
         self.logger.debug("Cannot poll requested URL: %s" % (detail))
 
 
+def find_patterns(body, patterns):
 
+    """
+    Search HTML for patterns (case insensitively). Runs in worker processes.
+
+    :param body: HTML content.
+    :type body: str.
+    :param patterns: Patterns to look for.
+    :type patterns: list.
+    :returns: list of matched patterns (lower case).
+    """
 
+    body = str(body).lower()
 
+    return [pattern.lower() for pattern in patterns if pattern.lower() in body]
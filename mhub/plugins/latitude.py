@@ -85,17 +85,19 @@ class LatitudePlugin(BasePlugin):
                 "timestamp": timestamp,
                 "location": location
             }
-            self.apply_zones(geo_coords, location)
-            self.publish(["o:location"], detail)
+            events = self.apply_zones(geo_coords, location)
+            events.append((["o:location"], detail))
+            self.publish_many(events)
         except Exception, e:
             self.logger.debug("Cannot parse Latitude response")
 
 
     def apply_zones(self, geo_coords, location):
 
-        """ Apply zone/perimeter checking """
+        """ Apply zone/perimeter checking, returning zone events to publish """
 
         lng_cur, lat_cur = geo_coords
+        events = list()
 
         for name, detail in self.zones.iteritems():
 
@@ -136,8 +138,10 @@ class LatitudePlugin(BasePlugin):
                                    inside=inside,
                                    outside=not inside,
                                    changed=changed)
-                self.publish("zone", zone_detail)
+                events.append(("zone", zone_detail))
 
             self.first_run = False
+
+        return events
         
         
@@ -91,7 +91,10 @@ class Pubnub():
 
         ## Capture User Input
         channel = args['channel']
-        message = json.dumps(args['message'])
+        if args.get('encoded') :
+            message = args['message']
+        else :
+            message = json.dumps(args['message'])
 
         ## Capture Callback
         if args.has_key('callback') :
@@ -38,20 +38,23 @@ class PubnubPlugin(BasePlugin):
             "callback": self.on_message
         })
 
-        self.subscribe(self.on_event)
+        self.subscribe(self.on_event, "NOT n:self", event=True)
 
 
-    def on_event(self, tags, detail):
+    def on_event(self, event):
 
         """
-        On event callback
+        On event callback (events published by this plugin are excluded)
         """
-        if "n:%s" % (self.name) not in tags:
-            self.pn.publish({
-                "channel": self.cfg.get("channel"),
-                "message": dict(tags=tags, detail=detail),
-                "callback": lambda c: None
-            })
+
+        if not self.forward_event(event): return
+
+        self.pn.publish({
+            "channel": self.cfg.get("channel"),
+            "message": event.json,
+            "encoded": True,
+            "callback": lambda c: None
+        })
 
 
     def on_connect(self):
@@ -72,6 +75,9 @@ class PubnubPlugin(BasePlugin):
         :type body: str.
         """
 
-        self.publish(["o:message"], body)
+        if isinstance(body, dict) and "id" in body:
+            self.receive_event(body, ["o:message"])
+        else:
+            self.publish(["o:message"], body)
 
 
@@ -14,6 +14,7 @@ class ScriptingPlugin(BasePlugin):
     default_config = {
         "enabled": False,
         "reload_interval": 300,
+        "thread_pool_size": 1,
         "resource_class": [
             "plugin.scripting"
         ]
@@ -34,13 +35,14 @@ class ScriptingPlugin(BasePlugin):
         self.invalid_scripts = set()
         
         self.load_scripts()
-        self.subscribe(self.process_event)
+        self.subscribe(self.process_event, executor="thread")
         
 
     def process_event(self, signal, detail):
 
         """
-        Service message process callback function.
+        Service message process callback function (runs in the plugin's
+        thread pool, serialised by its default single thread).
 
         :param msg: Message dictionary.
         :type msg: dict.
@@ -58,7 +60,7 @@ class ScriptingPlugin(BasePlugin):
             "db_find": self.db_find
         }
 
-        for rid, body in self.scripts.iteritems():
+        for rid, body in self.scripts.items():
             try:
                 exec(body, globals(), ctx)
             except Exception, e:
@@ -75,7 +77,20 @@ class ScriptingPlugin(BasePlugin):
         reload_interval = self.cfg.get("reload_interval", 60)
         cls = self.cfg.get("resource_class", "%s.%s" % ("plugin", self.cls))
 
-        resources = self.db_find("store", {"class": "%s.%s" % (self.cls, "script")}, list())
+        d = self.db_find_async("store", {"class": "%s.%s" % (self.cls, "script")})
+        d.addCallback(self.got_scripts)
+        d.addErrback(self.service.db_failed, "%s.script" % (self.cls))
+        d.addBoth(lambda _: self.service.reactor.callLater(reload_interval, self.load_scripts))
+
+
+    def got_scripts(self, resources):
+
+        """
+        Update loaded scripts from store resources.
+
+        :param resources: Script resources.
+        :type resources: list.
+        """
 
         for resource in resources:
             if resource["name"] in self.invalid_scripts:
@@ -87,6 +102,4 @@ class ScriptingPlugin(BasePlugin):
                 self.logger.debug("Body: %s" % (body))
                 self.scripts[name] = body
 
-        self.service.reactor.callLater(reload_interval, self.load_scripts)
-
 
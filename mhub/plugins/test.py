@@ -17,8 +17,8 @@ class TestPlugin(BasePlugin):
     def setup(self, cfg):
 
         BasePlugin.setup(self, cfg)
-        self.subscribe(self.process_event, "*.*.new_interval")
-        self.subscribe(self.process_event, "scheduler.*.*")
+        self.subscribe(self.process_event, ["o:interval"])
+        self.subscribe(self.process_event, ["c:scheduler", "o:*"])
 
     def process_event(self, signal, detail):
 
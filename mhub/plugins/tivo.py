@@ -76,7 +76,16 @@ class TivoProtocol(Protocol):
 
     def connectionMade(self):
 
-        self.plugin.subscribe(self.process_command, "%s.%s.command" % (self.plugin.cls, self.plugin.name))
+        self.subscription = self.plugin.subscribe(self.process_command,
+                                                  ["c:%s" % (self.plugin.cls),
+                                                   "n:%s" % (self.plugin.name),
+                                                   "i:command"],
+                                                  weak=True)
+
+
+    def connectionLost(self, reason):
+
+        self.subscription.cancel()
 
 
     def process_message(self, data):
@@ -8,6 +8,7 @@ from twisted.internet.task import LoopingCall
 from twittytwister import twitter
 
 from base import BasePlugin
+from store import RecentSet
 
 
 class TwitterPlugin(BasePlugin):
@@ -22,7 +23,8 @@ class TwitterPlugin(BasePlugin):
         "consumer_secret": "T5XYR3MIWcTVBe4V4ENrWBPeUSwChKz950xvrUoz98",
         "access_token": "changeme",
         "access_token_secret": "changeme",
-        "timeline": "bbcnews"
+        "timeline": "bbcnews",
+        "dedupe_window": 7 * 86400
     }
     
 
@@ -48,10 +50,11 @@ class TwitterPlugin(BasePlugin):
         self.tw = twitter.Twitter(consumer=self.consumer,
                                   token=self.token)
 
-        poll_task = LoopingCall(self.poll_tweets)
-        poll_task.start(self.cfg.get("poll_interval", 60))
+        self.tweet_ids = RecentSet(self.cfg.get("dedupe_window", 7 * 86400))
 
-        # self.db_remove("tweet_ids")
+        poll_task = LoopingCall(self.poll_tweets)
+        d = self.load_recent("tweet_ids", self.tweet_ids)
+        d.addBoth(lambda _: poll_task.start(self.cfg.get("poll_interval", 60)))
 
 
     def poll_tweets(self):
@@ -65,11 +68,7 @@ class TwitterPlugin(BasePlugin):
 
     def got_tweet(self, msg):
 
-        tweet_ids = self.db_get("cache", "tweet_ids", list())
-
-        if msg.id not in tweet_ids:
-
-            tweet_ids.append(msg.id)
+        if self.tweet_ids.add(msg.id):
 
             self.publish(["o:tweet"], {
                 "id": msg.id,
@@ -79,5 +78,5 @@ class TwitterPlugin(BasePlugin):
                 "created_at": msg.created_at
             })
 
-        self.db_set("cache", "tweet_ids", tweet_ids)
+            self.save_recent("tweet_ids", self.tweet_ids)
 
@@ -1,15 +1,16 @@
 import json
 import logging
 import os
+import time
 
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.internet.protocol import Protocol, Factory
 from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
 from twisted.web import static as Static, server, twcgi, script, vhost
 from lib.websocket import WebSocketHandler, WebSocketSite
 from twisted.web.resource import Resource
 from twisted.web.wsgi import WSGIResource
-from flask import Flask, g, request, render_template, redirect
+from flask import Flask, abort, g, jsonify, request, render_template, redirect
 from flaskext.wtf import Form as BaseForm, TextField, Required
 
 from base import BasePlugin
@@ -23,7 +24,8 @@ class WebPlugin(BasePlugin):
 
     default_config = {
         "enabled": False,
-        "port": 9002
+        "port": 9002,
+        "page_size": 50
     }
 
 
@@ -70,6 +72,31 @@ class WebPlugin(BasePlugin):
             self.publish(["c:mhub", "i:reconfigure"])
             return redirect("/")
 
+        @self.app.route("/api/timeseries/")
+        def api_timeseries():
+            names = self.timeseries_call("names")
+            return jsonify(series=[dict(sensor=s, measurement=m) for s, m in names])
+
+        @self.app.route("/api/timeseries/<sensor>/<measurement>/")
+        def api_timeseries_query(sensor, measurement):
+            try:
+                end = float(request.args.get("end", time.time()))
+                start = float(request.args.get("start", end - 86400))
+            except ValueError:
+                abort(400)
+            resolution = request.args.get("resolution", "auto")
+            if resolution not in ("auto", "raw", "minute", "hour", "day"):
+                abort(400)
+            resolution, points = self.timeseries_call("query", sensor, measurement,
+                                                      start, end, resolution)
+            return jsonify(sensor=sensor, measurement=measurement,
+                           resolution=resolution, points=points)
+
+        @self.app.route("/api/stats/")
+        def api_stats():
+            stats = threads.blockingCallFromThread(self.service.reactor, self.service.stats)
+            return jsonify(**stats)
+
         @self.app.route("/admin/")
         def admin():
             ctx = self.context_processor()
@@ -84,12 +111,18 @@ class WebPlugin(BasePlugin):
  
             ctx = self.context_processor()
 
-            store_items = self.service.db_find("store", {})
-            ctx["store_items"] = list(store_items)
+            page_size = self.cfg.get("page_size", 50)
+            after = request.args.get("after")
+            store_items = self.service.db_find("store", {},
+                                               fields=["name", "class"],
+                                               limit=page_size + 1,
+                                               after=after)
+            ctx["store_items"] = store_items[:page_size]
+            ctx["next_after"] = store_items[page_size - 1]["_id"] if len(store_items) > page_size else None
            
             return render_template("admin/db/list.html", **ctx)
 
-        @self.app.route("/admin/db/edit/<item_id>", methods=["GET", "POST"])
+        @self.app.route("/admin/db/edit/<path:item_id>", methods=["GET", "POST"])
         def admin_db_edit(item_id):
 
             ctx = self.context_processor()
@@ -117,6 +150,25 @@ class WebPlugin(BasePlugin):
             return form
 
 
+    def timeseries_call(self, method, *args):
+
+        """
+        Call a time series store method on the reactor thread (from a WSGI
+        request thread).
+
+        :param method: Method name.
+        :type method: str.
+        """
+
+        timeseries = self.service.timeseries
+
+        if timeseries is None:
+            abort(404)
+
+        return threads.blockingCallFromThread(self.service.reactor,
+                                              getattr(timeseries, method), *args)
+
+
     def context_processor(self):
 
         """ Default template context processor """
@@ -197,7 +249,10 @@ class WebSocketProtocol(WebSocketHandler):
         """ Connection made helper """
 
         print 'Connected to client.'
-        self.plugin.subscribe(self.process_event)
+        self.subscription = self.plugin.subscribe(self.process_event,
+                                                  dispatch="queued",
+                                                  event=True,
+                                                  weak=True)
 
 
     def connectionLost(self, reason):
@@ -205,16 +260,14 @@ class WebSocketProtocol(WebSocketHandler):
         """ Connection lost helper """
 
         print 'Lost connection.'
+        self.subscription.cancel()
 
 
-    def process_event(self, signal, detail):
+    def process_event(self, event):
 
         """ Event publisher helper """
 
-        msg = dict(signal=signal,
-                   detail=detail)
-
-        self.transport.write(json.dumps(msg))
+        self.transport.write(event.json)
 
 
 class FlashSocketPolicy(Protocol):
@@ -4,10 +4,20 @@ from txZMQ import ZmqFactory, ZmqEndpoint, ZmqPubConnection, ZmqSubConnection
 from plugins.base import BasePlugin
 
 
+ID_PREFIX = "x-id:"
+
+HOPS_PREFIX = "x-hops:"
+
+
 class ZmqPlugin(BasePlugin):
 
     """
     Zero Messaging Queue (ZMQ/0MQ) plugin.
+
+    Messages carry the event detail as JSON, with the event's tags as the
+    topic. The event id and hop count follow the tags in the topic as
+    "x-id:" and "x-hops:" tokens, so subscribers matching on tags are
+    unaffected.
     """
 
     default_config = {
@@ -33,19 +43,46 @@ class ZmqPlugin(BasePlugin):
         self.sub.subscribe("")
         self.sub.gotMessage = self.on_message
 
-        self.subscribe(self.process_event)
+        self.subscribe(self.process_event, "NOT n:self", dispatch="queued",
+                       event=True)
+
+
+    def process_event(self, event):
+
+        if not self.forward_event(event): return
+
+        topic = list(event.tags)
+        topic.append(ID_PREFIX + event.id)
+        topic.append(HOPS_PREFIX + str(event.hops))
+
+        self.pub.publish(event.detail_json, str(" ".join(topic)))
+
 
+    def on_message(self, detail, topic):
 
-    def process_event(self, tags, detail):
+        self.logger.debug("ZMQ: [%s] %s" % (topic, detail))
 
-        detail_json = str(json.dumps(detail))
+        envelope = dict(tags=list(), hops=0)
 
-        self.pub.publish(detail_json, str(" ".join(tags)))
+        for token in topic.split():
+            if token.startswith(ID_PREFIX):
+                envelope["id"] = token[len(ID_PREFIX):]
+            elif token.startswith(HOPS_PREFIX):
+                try:
+                    envelope["hops"] = int(token[len(HOPS_PREFIX):])
+                except ValueError:
+                    pass
+            else:
+                envelope["tags"].append(token)
 
+        if "id" not in envelope: return
 
-    def on_message(self, detail, tags):
+        try:
+            envelope["detail"] = json.loads(detail)
+        except ValueError:
+            return
 
-        self.logger.debug("ZMQ: [%s] %s" % (tags, detail))
+        self.receive_event(envelope)
 
 
 class MZMQFactory(ZmqFactory):
@@ -10,38 +10,44 @@ MHub Services Module
 
 """
 
-import datetime
-import fnmatch
+import itertools
 import json
 import logging
+import os
 import pprint
 import sys
+import time
 import traceback
 
-from pymongo import Connection
-from pymongo.objectid import ObjectId
-from pymongo.errors import AutoReconnect
+from operator import attrgetter
 from twisted.application.service import Service
-from twisted.internet import reactor, threads
-
-from plugins.amqp import AmqpPlugin
-from plugins.byebyestandby import ByeByeStandbyPlugin
-from plugins.echo import EchoPlugin
-from plugins.email import EmailPlugin
-from plugins.http import HttpPlugin
-from plugins.latitude import LatitudePlugin
-from plugins.mpd_client import MpdPlugin
-from plugins.owfs import OwfsPlugin
-from plugins.pubnub import PubnubPlugin
-from plugins.scheduler import SchedulerPlugin
-from plugins.scripting import ScriptingPlugin
-from plugins.telnet import TelnetPlugin
-from plugins.test import TestPlugin
-from plugins.tivo import TivoPlugin
-from plugins.twitter_client import TwitterPlugin
-from plugins.web import WebPlugin
-from plugins.xmpp import XmppPlugin
-from plugins.zmq import ZmqPlugin
+from twisted.internet import defer, reactor, threads
+from twisted.internet.task import LoopingCall
+from twisted.python.threadpool import ThreadPool
+
+from bus import CoalesceRule, Coalescer, DispatchQueue, Event, LimitRule, \
+    Query, RateLimiter, Subscription, SubscriptionIndex, WeakMethod, \
+    PRIORITIES, PRIORITY_HIGH, PRIORITY_NORMAL
+from journal import Journal, JournalReader, Replay, ReplaySource
+from timeseries import TimeSeriesStore
+from store import RecordCache, StoreError, WriteBuffer, STORES
+from workers import ProcessPool, resolve
+
+TAG_CACHE_SIZE = 4096
+
+PLUGIN_ENTRY_POINTS = "mhub.plugins"
+
+DB_COLLECTIONS = ("store", "cache")
+
+DB_INDEXES = [
+    ("store", "_id"),
+    ("store", "name"),
+    ("cache", "name"),
+    ("store", "class")
+]
+
+_MISSING = object()
+
 
 class BaseService(Service):
 
@@ -56,24 +62,24 @@ class BaseService(Service):
     """
 
     _class_map = {
-        "amqp": AmqpPlugin,
-        "byebyestandby": ByeByeStandbyPlugin,
-        "echo": EchoPlugin,
-        "email": EmailPlugin,
-        "http": HttpPlugin,
-        "latitude": LatitudePlugin,
-        "mpd": MpdPlugin,
-	"owfs": OwfsPlugin,
-        "pubnub": PubnubPlugin,
-        "scheduler": SchedulerPlugin,
-        "scripting": ScriptingPlugin,
-        "telnet": TelnetPlugin,
-        "test": TestPlugin,
-        "tivo": TivoPlugin,
-        "twitter": TwitterPlugin,
-        "web": WebPlugin,
-        "xmpp": XmppPlugin,
-        "zmq": ZmqPlugin
+        "amqp": "plugins.amqp:AmqpPlugin",
+        "byebyestandby": "plugins.byebyestandby:ByeByeStandbyPlugin",
+        "echo": "plugins.echo:EchoPlugin",
+        "email": "plugins.email:EmailPlugin",
+        "http": "plugins.http:HttpPlugin",
+        "latitude": "plugins.latitude:LatitudePlugin",
+        "mpd": "plugins.mpd_client:MpdPlugin",
+        "owfs": "plugins.owfs:OwfsPlugin",
+        "pubnub": "plugins.pubnub:PubnubPlugin",
+        "scheduler": "plugins.scheduler:SchedulerPlugin",
+        "scripting": "plugins.scripting:ScriptingPlugin",
+        "telnet": "plugins.telnet:TelnetPlugin",
+        "test": "plugins.test:TestPlugin",
+        "tivo": "plugins.tivo:TivoPlugin",
+        "twitter": "plugins.twitter_client:TwitterPlugin",
+        "web": "plugins.web:WebPlugin",
+        "xmpp": "plugins.xmpp:XmppPlugin",
+        "zmq": "plugins.zmq:ZmqPlugin"
     }
 
 
@@ -90,13 +96,72 @@ class BaseService(Service):
         self.logger = logging.getLogger("mhub.service")
         self.cfg = cfg
         self.plugins = dict()
+        self._class_map = dict(self._class_map)
         self.metadata = dict()
         self.subscriptions = list()
-
+        self.subscription_index = SubscriptionIndex()
+        self._subscription_seq = itertools.count()
+        self.thread_pools = dict()
+        self.workers = None
+        self.coalescer = None
+        self.limiter = None
+        self.tag_priorities = dict()
+        self.max_hops = 8
+        self.hop_drops = 0
+        self.write_buffer = None
+        self.read_cache = None
+        self.db_indexes = set()
+        self.slow_query = 0.1
+        self.journal = None
+        self.timeseries = None
+        self._tag_cache = dict()
+
+        self.setup_bus()
         self.setup_persistence()
+        self.setup_journal()
+        self.setup_timeseries()
         self.setup_plugins()
 
 
+    def setup_bus(self):
+
+        """
+        Initialise optional event bus stages from the "bus" configuration
+        """
+
+        bus_cfg = self.cfg.get("app").get("bus", dict())
+
+        rules = list()
+
+        for rule_cfg in bus_cfg.get("coalesce", list()):
+            rules.append(CoalesceRule(rule_cfg.get("key", ""),
+                                      rule_cfg.get("window", 1.0),
+                                      rule_cfg.get("mode", "latest")))
+
+        if rules:
+            the_reactor = self.reactor or reactor
+            self.coalescer = Coalescer(the_reactor, rules, self._publish_event)
+            the_reactor.addSystemEventTrigger("before", "shutdown", self.coalescer.flush)
+            self.logger.info("Coalescing %i tag sets" % (len(rules)))
+
+        limits = list()
+
+        for limit_cfg in bus_cfg.get("limits", list()):
+            limits.append(LimitRule(limit_cfg.get("match", ""),
+                                    rate=limit_cfg.get("rate"),
+                                    burst=limit_cfg.get("burst"),
+                                    sample=limit_cfg.get("sample")))
+
+        if limits:
+            self.limiter = RateLimiter(limits, (self.reactor or reactor).seconds)
+            self.logger.info("Rate limiting %i tag queries" % (len(limits)))
+
+        self.max_hops = bus_cfg.get("max_hops", 8)
+
+        for tag, priority in bus_cfg.get("priorities", dict()).iteritems():
+            self.tag_priorities[tag] = PRIORITIES[priority]
+
+
     def setup_persistence(self):
 
         """
@@ -106,28 +171,132 @@ class BaseService(Service):
         self.logger.info("Initialising persistence")
 
         app_cfg = self.cfg.get("app")
+        general_cfg = app_cfg.get("general")
+        db_cfg = app_cfg.get("db", dict())
+        backend = db_cfg.get("backend", "mongo")
 
-        store_host = app_cfg.get("general").get("store_host", "localhost")
-        store_port = app_cfg.get("general").get("store_port", 27017)
+        try:
 
-        self.logger.debug("MongoDB: %s:%i" % (store_host, store_port))
+            if backend == "sqlite":
+                path = db_cfg.get("path") or os.path.join(general_cfg.get("cache_dir"), "mhub.db")
+                self.logger.debug("SQLite: %s" % (path))
+                self.db = STORES[backend](path)
+            else:
+                store_host = general_cfg.get("store_host", "localhost")
+                store_port = general_cfg.get("store_port", 27017)
+                self.logger.debug("MongoDB: %s:%i" % (store_host, store_port))
+                self.db = STORES[backend](store_host, store_port, "mhub")
+
+            self.slow_query = db_cfg.get("slow_query", 0.1)
+
+            for collection, field in DB_INDEXES:
+                self.db_ensure_index(collection, field)
+
+            the_reactor = self.reactor or reactor
+            self.db_pool = ThreadPool(1, max(1, int(db_cfg.get("threads", 4))), "mhub.db")
+            the_reactor.callWhenRunning(self.db_pool.start)
+            the_reactor.addSystemEventTrigger("during", "shutdown", self.db_pool.stop)
+
+            write_interval = db_cfg.get("write_interval", 1.0)
+            if write_interval:
+                self.write_buffer = WriteBuffer(the_reactor, self._db_write,
+                                                write_interval,
+                                                db_cfg.get("write_batch", 500))
+                self.logger.debug("Buffering writes for %.1fs" % (write_interval))
+
+            cache_size = db_cfg.get("cache_size", 1000)
+            if cache_size:
+                self.read_cache = RecordCache(cache_size, db_cfg.get("cache_ttl", 60.0))
+                self.subscribe(self._db_reconfigure, ["i:reconfigure"])
+                self.logger.debug("Caching up to %i records" % (cache_size))
+
+            d = self.db_set_async("cache", "_config", app_cfg)
+            d.addErrback(self.db_failed, "_config")
+
+        except StoreError, e:
+            
+            self.logger.fatal("Exiting, cannot open %s store: %s" % (backend, e))
+            sys.exit(1)
 
-        try:
 
-            self.mongo_connection = Connection()
-            self.mongo_db = self.mongo_connection["mhub"]
-            self.store = self.mongo_db["store"]
-            self.cache = self.mongo_db["cache"]
+    def setup_journal(self):
+
+        """
+        Initialise the event journal, if enabled in the "journal" configuration
+        """
+
+        app_cfg = self.cfg.get("app")
+        journal_cfg = app_cfg.get("journal", dict())
 
-            self._db_map = dict(store=self.store,
-                                cache=self.cache)
+        if not journal_cfg.get("enabled"): return
 
-            self.db_set(self.cache, "_config", app_cfg)
+        the_reactor = self.reactor or reactor
+        path = journal_cfg.get("path") or os.path.join(app_cfg.get("general").get("cache_dir"), "journal")
 
-        except AutoReconnect, e:
-            
-            self.logger.fatal("Exiting, cannot connect to MongoDB")
-            sys.exit(1)
+        self.journal = Journal(the_reactor, path,
+                               segment_size=journal_cfg.get("segment_size", 64 * 1024 * 1024),
+                               segments=journal_cfg.get("segments", 0),
+                               flush_interval=journal_cfg.get("flush_interval", 0.5),
+                               index_interval=journal_cfg.get("index_interval", 1.0),
+                               fmt=journal_cfg.get("format", "json"))
+        the_reactor.callWhenRunning(self.journal.start)
+        the_reactor.addSystemEventTrigger("before", "shutdown", self.journal.stop)
+
+        self.subscribe(self.journal.record, event=True)
+        self.logger.info("Journalling events to '%s'" % (path))
+
+
+    def replay_journal(self, start=None, end=None, speed=1.0):
+
+        """
+        Replay journalled events onto the bus
+
+        :param start: Earliest timestamp (inclusive).
+        :type start: float.
+        :param end: Latest timestamp (exclusive).
+        :type end: float.
+        :param speed: Playback speed multiplier (0 for as fast as possible).
+        :type speed: float.
+        :returns: journal.Replay
+        """
+
+        if self.journal is None:
+            raise ValueError("The event journal is not enabled")
+
+        replay = Replay(self.reactor or reactor, JournalReader(self.journal.path),
+                        lambda batch: self.publish_many(batch, ReplaySource),
+                        start, end, speed)
+        replay.start()
+
+        return replay
+
+
+    def setup_timeseries(self):
+
+        """
+        Initialise the sensor reading time series, if enabled in the
+        "timeseries" configuration
+        """
+
+        app_cfg = self.cfg.get("app")
+        ts_cfg = app_cfg.get("timeseries", dict())
+
+        if not ts_cfg.get("enabled", True): return
+
+        the_reactor = self.reactor or reactor
+        path = ts_cfg.get("path") or os.path.join(app_cfg.get("general").get("cache_dir"), "timeseries.dat")
+
+        self.timeseries = TimeSeriesStore(ts_cfg.get("chunk_size", 1024),
+                                          ts_cfg.get("raw_points", 10080))
+        self.timeseries.load(path)
+
+        save_interval = ts_cfg.get("save_interval", 300)
+        save_task = LoopingCall(self.timeseries.save, path)
+        the_reactor.callWhenRunning(save_task.start, save_interval, False)
+        the_reactor.addSystemEventTrigger("before", "shutdown", self.timeseries.save, path)
+
+        self.subscribe(self.timeseries.record, ts_cfg.get("query", "o:status"), event=True)
+        self.logger.info("Recording time series of '%s' readings" % (ts_cfg.get("query", "o:status")))
 
 
     def setup_plugins(self):
@@ -144,9 +313,19 @@ class BaseService(Service):
         for name, plugin_cfg in plugins_cfg.iteritems():
 
             p_cls_str = plugin_cfg.get("class").lower()
-            p_cls = self._class_map.get(p_cls_str)
             p_enabled = plugin_cfg.get("enabled", False)
             if not p_enabled: continue
+
+            try:
+                p_cls = self.plugin_class(p_cls_str)
+            except ImportError, e:
+                self.logger.error("Cannot load %s.%s: %s" % (p_cls_str, name, e))
+                continue
+
+            if p_cls is None:
+                self.logger.error("Unknown plugin class '%s' for '%s'" % (p_cls_str, name))
+                continue
+
             p_inst = p_cls()
             p_inst.name = name
             p_inst.cls = p_cls_str
@@ -154,87 +333,628 @@ class BaseService(Service):
             p_inst.logger = logging.getLogger("plugin")
             p_inst.setup(plugin_cfg)
 
+            self.plugins[name] = p_inst
             self.logger.debug("%s.%s registered" % (p_cls_str, name))
             
             if hasattr(p_inst, "client"):
                 p_inst.client.setServiceParent(self.app.root_service)
 
 
-    def publish(self, tags, detail, plugin):
+    def plugin_class(self, cls):
+
+        """
+        Get a plugin class by its configured class name, importing its module
+        on first use
+
+        Built-in plugins are listed in ``_class_map`` as "module:Class" paths.
+        Other classes are looked up in the "mhub.plugins" setuptools entry
+        point group, so third-party packages can add plugins with e.g.
+        ``entry_points={"mhub.plugins": ["lights = mylights.plugin:LightsPlugin"]}``.
+
+        :param cls: Plugin class name (e.g. "owfs").
+        :type cls: str.
+        :returns: Plugin class, or None if the name is unknown
+        """
+
+        p_cls = self._class_map.get(cls)
+
+        if p_cls is None:
+            p_cls = self._entry_point_class(cls)
+        elif isinstance(p_cls, basestring):
+            p_cls = resolve(p_cls)
+
+        if p_cls is not None:
+            self._class_map[cls] = p_cls
+
+        return p_cls
+
+
+    def _entry_point_class(self, cls):
+
+        """
+        Load a plugin class registered through setuptools entry points
+        """
+
+        try:
+            import pkg_resources
+        except ImportError:
+            return None
+
+        for entry_point in pkg_resources.iter_entry_points(PLUGIN_ENTRY_POINTS, cls):
+            return entry_point.load()
+
+        return None
+
+
+    def publish(self, tags, detail, plugin, event_id=None, hops=0):
 
         """
         Publish event to service
+
+        :param tags: Event tags.
+        :type tags: list.
+        :param detail: Detail dictionary.
+        :type detail: dict.
+        :param plugin: Publishing plugin.
+        :type plugin: BasePlugin.
+        :param event_id: Id of a relayed event (a new id is generated if None).
+        :type event_id: str.
+        :param hops: Number of bridges a relayed event has crossed.
+        :type hops: int.
         """
 
-        if type(tags) == str: tags = [tags]
         if detail is None: detail = dict()
 
-        now = datetime.datetime.now()
+        if hops > self.max_hops:
+            self.hop_drops += 1
+            self.logger.debug("Dropped event '%s' after %i hops" % (event_id, hops))
+            return
+
+        tags, ids, mask, priority = self._event_tags(tags, plugin)
 
-        tags = set(tags)
+        if self.limiter is not None and not self.limiter.allow(tags, plugin.name):
+            return
 
-        tags = map(lambda t: "u:%s" % (t) if t[1] != ":" else "%s" % (t), tags)
+        event = Event(tags, detail, time.time(), plugin.name, priority, event_id, hops)
 
-        if not filter(lambda tag: tag.startswith("n:"), tags):
-            tags.append("n:%s" % (plugin.name))
+        if self.coalescer is not None and self.coalescer.offer(event):
+            return
 
-        if not filter(lambda tag: tag.startswith("c:"), tags):
-            tags.append("c:%s" % (plugin.cls))
+        self._publish_event(event, ids, mask)
 
-        if not filter(lambda tag: tag.startswith("h:"), tags):
-            tags.append("h:%s" % (self.cfg.get("app").get("general").get("name")))
 
-    	tags = sorted(tags)
+    def _publish_event(self, event, ids=None, mask=None):
+
+        """
+        Dispatch a built event to all matching subscriptions
+        """
+
+        if ids is None:
+            ids, mask = self.subscription_index.registry.lookup(event.tags)
 
         match_count = 0
 
-        for subscription in self.subscriptions:
+        for subscription in self.subscription_index.match(ids, mask):
 
-            func, query = subscription
+            if subscription.batch:
+                self._dispatch(subscription, [event])
+            else:
+                self._dispatch(subscription, event)
 
-            if query.issubset(tags):
- 
-                try:
-                    func(tags, detail)
-                except Exception, e:
-                    tb = traceback.format_exc()
-                    self.logger.debug("Cannot call callback '%s'" % (func.__name__))
-                    self.logger.debug(e)
-                    self.logger.debug(tb)
+            match_count += 1
 
-                match_count += 1
+        self.logger.debug("Published event '%s' (%i receivers)" % (event.tags, match_count))
+        self.logger.debug("Detail: %s" % (event.detail))
 
-        self.logger.debug("Published event '%s' (%i receivers)" % (tags, match_count))
-        self.logger.debug("Detail: %s" % (detail))
 
+    def publish_many(self, events, plugin):
 
-    def subscribe(self, func, query=None):
+        """
+        Publish a batch of events to service
+
+        Tags are normalised once per distinct tag list and subscriptions are
+        matched once per distinct tag set. High priority events in the batch
+        are dispatched ahead of the rest. Batch subscribers receive all of
+        their matching events in a single callback.
+
+        :param events: Sequence of (tags, detail) pairs.
+        :type events: list.
+        :param plugin: Publishing plugin.
+        :type plugin: BasePlugin.
+        """
+
+        prepared = list()
+        matched = dict()
+        batches = dict()
+        event_count = 0
+        now = time.time()
+
+        for tags, detail in events:
+
+            if detail is None: detail = dict()
+
+            tags, ids, mask, priority = self._event_tags(tags, plugin)
+
+            if self.limiter is not None and not self.limiter.allow(tags, plugin.name):
+                continue
+
+            event = Event(tags, detail, now, plugin.name, priority)
+
+            if self.coalescer is not None and self.coalescer.offer(event):
+                continue
+
+            prepared.append((event, ids, mask))
+
+        prepared.sort(key=lambda p: p[0].priority)
+
+        for event, ids, mask in prepared:
+
+            tags = event.tags
+            subscriptions = matched.get(tags)
+            if subscriptions is None:
+                subscriptions = matched[tags] = self.subscription_index.match(ids, mask)
+
+            for subscription in subscriptions:
+                if subscription.batch:
+                    batches.setdefault(subscription, list()).append(event)
+                else:
+                    self._dispatch(subscription, event)
+
+            event_count += 1
+
+        for subscription in sorted(batches, key=attrgetter("seq")):
+            self._dispatch(subscription, batches[subscription])
+
+        self.logger.debug("Published %i events (%i tag sets)" % (event_count, len(matched)))
+
+
+    def subscribe(self, func, query=None, dispatch=None, queue_size=None,
+                  overflow=None, batch=False, event=False, weak=False,
+                  executor=None, plugin=None):
     
         """
         Create a subscription to a service event based on pattern matching
+
+        :param func: Callback function.
+        :type func: function.
+        :param query: List of tags which must all be present on an event, or a
+                      query string such as "c:owfs AND NOT n:self" (see
+                      :class:`bus.Query`). Tags may be glob-style patterns
+                      such as "n:sensor*" or "c:*".
+        :type query: list.
+        :param dispatch: "sync" to call back inside publish, "queued" to
+                         deliver from a bounded per-subscription queue.
+        :type dispatch: str.
+        :param queue_size: Maximum pending events for queued dispatch.
+        :type queue_size: int.
+        :param overflow: Queue overflow policy ("drop_oldest", "drop_newest"
+                         or "block").
+        :type overflow: str.
+        :param batch: Receive a list of events per callback instead of one
+                      event at a time.
+        :type batch: bool.
+        :param event: Receive :class:`bus.Event` objects instead of
+                      (tags, detail) arguments.
+        :type event: bool.
+        :param weak: Hold the callback weakly; the subscription is removed
+                     once its object is garbage collected.
+        :type weak: bool.
+        :param executor: "thread" to run the callback in the subscribing
+                         plugin's thread pool instead of on the reactor, or
+                         "process" to run it in the worker process pool. For
+                         "process", ``func`` is a "module:function" path and
+                         any (tags, detail) pairs it returns are published
+                         back onto the bus by ``plugin``.
+        :type executor: str.
+        :param plugin: Subscribing plugin (selects its thread pool).
+        :type plugin: BasePlugin.
+        :returns: Subscription handle (see :meth:`unsubscribe`).
+        """
+
+        query = Query.parse(query, getattr(plugin, "name", None))
+
+        subscription = Subscription(func, query, next(self._subscription_seq),
+                                    batch=batch, event=event)
+        subscription.plugin = plugin
+        subscription.canceller = self.unsubscribe
+
+        if weak:
+            subscription.func = WeakMethod(func, lambda ref: self.unsubscribe(subscription))
+
+        if executor == "thread":
+            subscription.pool = self.thread_pool(plugin)
+        elif executor == "process":
+            if plugin is None or not isinstance(func, basestring):
+                raise ValueError("Process subscriptions need a plugin and a function path")
+            subscription.workers = self.process_pool()
+        elif executor is not None:
+            raise ValueError("Unknown executor '%s'" % (executor))
+
+        bus_cfg = self.cfg.get("app").get("bus", dict())
+        dispatch = dispatch or bus_cfg.get("dispatch", "sync")
+
+        if dispatch == "queued":
+            subscription.queue = DispatchQueue(
+                lambda item: self._deliver(subscription, item),
+                self.reactor or reactor,
+                size=queue_size or bus_cfg.get("queue_size", 1000),
+                overflow=overflow or bus_cfg.get("overflow", "drop_oldest"),
+                batch=bus_cfg.get("drain_batch", 100))
+
+        self.logger.debug("Subscribed query '%s' with '%s' (%s)" % (query, self._callback_name(func), dispatch))
+        self.subscriptions.append(subscription)
+        self.subscription_index.add(subscription)
+
+        return subscription
+
+
+    def unsubscribe(self, subscription):
+
         """
+        Remove a subscription created by :meth:`subscribe`
 
-        if query is None:
-            query = list()
+        :param subscription: Subscription handle.
+        :type subscription: bus.Subscription.
+        """
+
+        if not subscription.active: return
+
+        subscription.active = False
+        self.subscription_index.remove(subscription)
+
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
 
-	query = set(query)
+        if subscription.queue is not None:
+            subscription.queue.close()
 
-        self.logger.debug("Subscribed query '%s' with '%s'" % (query, func.__name__))
-        self.subscriptions.append((func, query))
+        self.logger.debug("Unsubscribed query '%s' from '%s'" % (subscription.query, self._callback_name(subscription.func)))
 
 
-    def db_find(self, collection, query, scope="service"):
+    def thread_pool(self, plugin=None):
 
         """
-        Retrieve value from configured database connection
+        Get the thread pool used to run a plugin's blocking callbacks
+
+        Each plugin gets its own pool, sized by its ``thread_pool_size``
+        setting, so one plugin's slow callbacks cannot starve another's. The
+        reactor's shared pool is used when no plugin is given.
+
+        :param plugin: Plugin instance.
+        :type plugin: BasePlugin.
+        :returns: twisted.python.threadpool.ThreadPool
+        """
+
+        the_reactor = self.reactor or reactor
+
+        if plugin is None:
+            return the_reactor.getThreadPool()
+
+        pool = self.thread_pools.get(plugin.name)
+
+        if pool is None:
+            bus_cfg = self.cfg.get("app").get("bus", dict())
+            default_size = getattr(plugin, "default_config", dict()).get(
+                "thread_pool_size", bus_cfg.get("thread_pool_size", 4))
+            size = plugin.cfg.get("thread_pool_size", default_size)
+            pool = ThreadPool(1, max(1, int(size)), "mhub.%s" % (plugin.name))
+            the_reactor.callWhenRunning(pool.start)
+            the_reactor.addSystemEventTrigger("during", "shutdown", pool.stop)
+            self.thread_pools[plugin.name] = pool
+            self.logger.debug("Thread pool for '%s' (%i threads)" % (plugin.name, pool.max))
+
+        return pool
+
+
+    def process_pool(self):
+
+        """
+        Get the shared worker process pool, creating it on first use
+
+        The pool size is taken from ``process_workers`` in the bus section of
+        the application configuration and defaults to the number of CPUs.
+
+        :returns: workers.ProcessPool
+        """
+
+        if self.workers is None:
+            the_reactor = self.reactor or reactor
+            bus_cfg = self.cfg.get("app").get("bus", dict())
+            self.workers = ProcessPool(the_reactor,
+                                       size=bus_cfg.get("process_workers"),
+                                       restart_delay=bus_cfg.get("process_restart_delay", 1.0))
+            the_reactor.callWhenRunning(self.workers.start)
+            the_reactor.addSystemEventTrigger("before", "shutdown", self.workers.stop)
+
+        return self.workers
+
+
+    def coalesce_stats(self):
+
+        """
+        Report how many events each coalescing rule received, absorbed and emitted
+
+        :returns: list of dict
+        """
+
+        if self.coalescer is None:
+            return list()
+
+        return self.coalescer.stats()
+
+
+    def limit_stats(self):
+
+        """
+        Report passed, rate limited and sampled out event counts per source
+
+        :returns: dict
+        """
+
+        if self.limiter is None:
+            return dict()
+
+        return self.limiter.stats()
+
+
+    def queue_stats(self):
+
+        """
+        Report dispatch queue depths, so slow subscribers can be identified.
+
+        :returns: list of dict
+        """
+
+        stats = list()
+
+        for subscription in self.subscriptions:
+            if subscription.queue is None: continue
+            entry = subscription.queue.stats()
+            entry["callback"] = self._callback_name(subscription.func)
+            entry["query"] = str(subscription.query)
+            stats.append(entry)
+
+        return stats
+
+
+    def stats(self):
+
+        """
+        Collect bus, persistence and journal statistics
+
+        :returns: dict
+        """
+
+        stats = dict(hop_drops=self.hop_drops,
+                     coalesce=self.coalesce_stats(),
+                     limits=self.limit_stats(),
+                     queues=self.queue_stats(),
+                     db=self.db_stats())
+
+        if self.journal is not None:
+            stats["journal"] = self.journal.stats()
+
+        if self.timeseries is not None:
+            stats["timeseries"] = dict(series=len(self.timeseries.series),
+                                       readings=self.timeseries.readings)
+
+        return stats
+
+
+    def _event_tags(self, tags, plugin):
+
+        """
+        Normalised tags, interned tag ids and bitmask for a published tag list
+
+        Results are cached per plugin and raw tag list, so plugins that keep
+        publishing the same tags only pay for normalisation once. Cached ids
+        are refreshed whenever subscriptions intern new tags.
+        """
+
+        raw = tags if type(tags) in (str, unicode) else tuple(tags)
+        key = (plugin.name, plugin.cls, raw)
+        registry = self.subscription_index.registry
+
+        entry = self._tag_cache.get(key)
+
+        if entry is None:
+            if len(self._tag_cache) >= TAG_CACHE_SIZE:
+                self._tag_cache.clear()
+            tags = self._normalise_tags(raw, plugin)
+            priority = self._event_priority(tags, plugin)
+            entry = self._tag_cache[key] = [tags, None, 0, -1, priority]
+
+        if entry[3] != registry.generation:
+            entry[1], entry[2] = registry.lookup(entry[0])
+            entry[3] = registry.generation
+
+        return entry[0], entry[1], entry[2], entry[4]
+
+
+    def _event_priority(self, tags, plugin):
+
+        """
+        Dispatch priority of an event, from its plugin or tag configuration
+
+        A plugin's ``priority`` setting applies to everything it publishes;
+        otherwise the highest priority configured for any of the event's tags
+        (in the bus ``priorities`` mapping) is used.
+        """
+
+        plugin_priority = getattr(plugin, "cfg", dict()).get("priority")
+
+        if plugin_priority is not None:
+            return PRIORITIES[plugin_priority]
+
+        priority = PRIORITY_NORMAL
+
+        for tag in tags:
+            priority = min(priority, self.tag_priorities.get(tag, PRIORITY_NORMAL))
+
+        return priority
+
+
+    def _normalise_tags(self, tags, plugin):
+
+        """
+        Prefixes untyped tags and adds default name, class and host tags
+        """
+
+        if type(tags) in (str, unicode): tags = [tags]
+
+        normalised = set()
+
+        for tag in tags:
+            if tag[1] != ":": tag = "u:%s" % (tag)
+            normalised.add(tag)
+
+        prefixes = set(tag[:2] for tag in normalised)
+
+        if "n:" not in prefixes:
+            normalised.add("n:%s" % (plugin.name))
+
+        if "c:" not in prefixes:
+            normalised.add("c:%s" % (plugin.cls))
+
+        if "h:" not in prefixes:
+            normalised.add("h:%s" % (self.cfg.get("app").get("general").get("name")))
+
+        return tuple(sorted(normalised))
+
+
+    def _dispatch(self, subscription, item):
+
+        """
+        Deliver an event (or batch of events) now, or via the subscription's queue
+        """
+
+        if subscription.queue is None:
+            self._deliver(subscription, item)
+        elif subscription.batch:
+            high = min(event.priority for event in item) == PRIORITY_HIGH
+            subscription.queue.put(item, high)
+        else:
+            subscription.queue.put(item, item.priority == PRIORITY_HIGH)
+
+
+    def _deliver(self, subscription, item):
+
+        """
+        Invoke a subscription callback, logging any errors it raises
         """
 
-        db_collection = self._db_map.get(collection, self.cache)
+        if not subscription.active: return
+
+        func = subscription.func
+
+        if subscription.event:
+            args = (item,)
+        elif subscription.batch:
+            args = ([(event.tags, event.detail) for event in item],)
+        else:
+            args = (item.tags, item.detail)
+
+        if subscription.pool is not None:
+            d = threads.deferToThreadPool(self.reactor or reactor,
+                                          subscription.pool, func, *args)
+            d.addErrback(self._deliver_failed, func)
+            return
+
+        if subscription.workers is not None:
+            d = subscription.workers.call(func, *args)
+            d.addCallback(self._worker_results, subscription.plugin)
+            d.addErrback(self._deliver_failed, func)
+            return
+
+        try:
+            func(*args)
+        except Exception, e:
+            tb = traceback.format_exc()
+            self.logger.debug("Cannot call callback '%s'" % (func.__name__))
+            self.logger.debug(e)
+            self.logger.debug(tb)
+
+
+    def _worker_results(self, events, plugin):
+
+        """
+        Publish events returned by a worker process callback
+        """
+
+        if events:
+            self.publish_many(events, plugin)
+
+
+    def _deliver_failed(self, failure, func):
+
+        """
+        Log an error raised by a callback run in a thread or worker pool
+        """
+
+        self.logger.debug("Cannot call callback '%s'" % (self._callback_name(func)))
+        self.logger.debug(failure.getErrorMessage())
+        self.logger.debug(failure.getTraceback())
+
+
+    def _callback_name(self, func):
+
+        """
+        Generates a readable name for a subscription callback
+        """
+
+        if isinstance(func, basestring):
+            return func
+
+        owner = getattr(func, "im_self", None)
+
+        if owner is None:
+            return func.__name__
+
+        return "%s.%s" % (getattr(owner, "name", owner.__class__.__name__),
+                          func.__name__)
+
+
+    def db_find(self, collection, query, scope="service", fields=None,
+                sort=None, limit=None, after=None):
+
+        """
+        Retrieve value from configured database connection
+
+        Large collections can be read a page at a time: pass ``limit`` and,
+        for each following page, the ``_id`` of the last record received as
+        ``after``. Limited queries without a sort order are in ``_id`` order.
+
+        :param collection: Collection name ("store" or "cache").
+        :type collection: str.
+        :param query: Query dictionary.
+        :type query: dict.
+        :param fields: Fields to return (``_id`` is always included).
+        :type fields: list.
+        :param sort: Field name, or (field, direction) pairs with direction 1
+                     (ascending) or -1 (descending).
+        :type sort: list.
+        :param limit: Maximum number of records.
+        :type limit: int.
+        :param after: Return records after this ``_id``.
+        :returns: list
+        """
 
         if query is None: query = dict()
 
-        records = db_collection.find(query)
-        if not records: return list()
+        if isinstance(sort, basestring):
+            sort = [(sort, 1)]
+
+        if after is not None and sort and sort != [("_id", 1)]:
+            raise ValueError("Paged queries are always in _id order")
+
+        if after is not None or (limit and not sort):
+            sort = [("_id", 1)]
+
+        start = time.time()
+        records = list(self.db.find(self._db_collection(collection), query,
+                                    fields, sort, limit, after))
+        self._db_timed(collection, query, start)
+
         return records
 
 
@@ -244,30 +964,40 @@ class BaseService(Service):
         Retrieve value from configured database connection
         """
 
-        db_collection = self._db_map.get(collection, self.cache)
-
-        if query is None:
-            query = dict()
-        elif type(query) in (str, unicode):
-            query = ObjectId(query)
+        if query is None: query = dict()
 
-        print collection, query, type(query)
+        start = time.time()
+        record = self.db.find_one(self._db_collection(collection), query)
+        self._db_timed(collection, query, start)
 
-        record = db_collection.find_one(query)
         return record
 
 
-
     def db_get(self, collection, name, default=None, scope="service"):
 
         """
         Retrieve value from configured database connection
         """
 
-        db_collection = self._db_map.get(collection, self.cache)
-
         db_name = self._db_name(name, scope)
-        existing = db_collection.find_one({"name": db_name})
+
+        key = (collection, db_name)
+
+        if self.write_buffer is not None:
+            pending = self.write_buffer.get(key, _MISSING)
+            if pending is not _MISSING:
+                return pending
+
+        if self.read_cache is not None:
+            hit, cached = self.read_cache.get(key)
+            if hit:
+                return default if cached is None else cached["value"]
+            token = self.read_cache.token()
+
+        existing = self.db.get(self._db_collection(collection), db_name)
+
+        if self.read_cache is not None:
+            self.read_cache.put(key, existing, token)
         
         if existing:
             return existing["value"]
@@ -275,16 +1005,367 @@ class BaseService(Service):
             return default
 
 
+    def db_get_many(self, collection, names, default=None, scope="service"):
+
+        """
+        Retrieve several values from configured database connection
+
+        Values not already buffered or cached are fetched with a single
+        query.
+
+        :param collection: Collection name ("store" or "cache").
+        :type collection: str.
+        :param names: Record names.
+        :type names: list.
+        :param default: Value used for names with no record.
+        :returns: dict -- values by name
+        """
+
+        values = dict()
+        missing = dict()
+
+        for name in names:
+
+            db_name = self._db_name(name, scope)
+            key = (collection, db_name)
+
+            if self.write_buffer is not None:
+                pending = self.write_buffer.get(key, _MISSING)
+                if pending is not _MISSING:
+                    values[name] = pending
+                    continue
+
+            if self.read_cache is not None:
+                hit, cached = self.read_cache.get(key)
+                if hit:
+                    values[name] = default if cached is None else cached["value"]
+                    continue
+
+            missing[db_name] = name
+
+        if not missing:
+            return values
+
+        if self.read_cache is not None:
+            token = self.read_cache.token()
+
+        records = self.db.get_many(self._db_collection(collection), missing.keys())
+
+        for db_name, name in missing.iteritems():
+            existing = records.get(db_name)
+            if self.read_cache is not None:
+                self.read_cache.put((collection, db_name), existing, token)
+            values[name] = existing["value"] if existing else default
+
+        return values
+
+
     def db_set(self, collection, name, value, scope="service"):
 
         """
         Store value in configured database connection
+
+        When write buffering is enabled the value is queued and written with
+        the next flush; :meth:`db_get` returns it in the meantime.
         """
- 
-        db_collection = self._db_map.get(collection, self.cache)
 
         db_name = self._db_name(name, scope) 
-        db_collection.update({"name": db_name}, {"name": db_name, "value": value}, upsert=True)
+
+        if self.read_cache is not None:
+            self.read_cache.invalidate((collection, db_name))
+
+        if self.write_buffer is not None:
+            self.write_buffer.put((collection, db_name), value)
+            return
+
+        self.db.set(self._db_collection(collection), db_name, value)
+
+
+    def db_set_many(self, collection, values, scope="service"):
+
+        """
+        Store several values in configured database connection
+
+        The values are written with a single bulk upsert (or with the next
+        buffered flush).
+
+        :param collection: Collection name ("store" or "cache").
+        :type collection: str.
+        :param values: Values by record name.
+        :type values: dict.
+        """
+
+        records = [((collection, self._db_name(name, scope)), value)
+                   for name, value in values.iteritems()]
+
+        if self.read_cache is not None:
+            for key, value in records:
+                self.read_cache.invalidate(key)
+
+        if self.write_buffer is not None:
+            for key, value in records:
+                self.write_buffer.put(key, value)
+            return
+
+        self._db_upsert(records)
+
+
+    def db_find_async(self, collection, query, scope="service", **kwargs):
+
+        """
+        Non-blocking :meth:`db_find`, run in the database thread pool
+
+        :param collection: Collection name ("store" or "cache").
+        :type collection: str.
+        :param query: Query dictionary.
+        :type query: dict.
+        :returns: Deferred firing with a list of records
+        """
+
+        return self._db_call(self.db_find, collection, query, scope, **kwargs)
+
+
+    def db_find_one_async(self, collection, query, scope="service"):
+
+        """
+        Non-blocking :meth:`db_find_one`, run in the database thread pool
+
+        :param collection: Collection name ("store" or "cache").
+        :type collection: str.
+        :param query: Query dictionary or object id string.
+        :type query: dict.
+        :returns: Deferred firing with the record (or None)
+        """
+
+        return self._db_call(self.db_find_one, collection, query, scope)
+
+
+    def db_get_async(self, collection, name, default=None, scope="service"):
+
+        """
+        Non-blocking :meth:`db_get`, run in the database thread pool
+
+        :param collection: Collection name ("store" or "cache").
+        :type collection: str.
+        :param name: Record name.
+        :type name: str.
+        :param default: Value returned when no record exists.
+        :returns: Deferred firing with the value
+        """
+
+        return self._db_call(self.db_get, collection, name, default, scope)
+
+
+    def db_get_many_async(self, collection, names, default=None, scope="service"):
+
+        """
+        Non-blocking :meth:`db_get_many`, run in the database thread pool
+
+        :returns: Deferred firing with values by name
+        """
+
+        return self._db_call(self.db_get_many, collection, names, default, scope)
+
+
+    def db_set_async(self, collection, name, value, scope="service"):
+
+        """
+        Non-blocking :meth:`db_set`, run in the database thread pool
+
+        :param collection: Collection name ("store" or "cache").
+        :type collection: str.
+        :param name: Record name.
+        :type name: str.
+        :param value: Value to store.
+        :returns: Deferred firing once the value is written
+        """
+
+        if self.write_buffer is not None:
+            self.db_set(collection, name, value, scope)
+            return self.write_buffer.flushed()
+
+        return self._db_call(self.db_set, collection, name, value, scope)
+
+
+    def db_set_many_async(self, collection, values, scope="service"):
+
+        """
+        Non-blocking :meth:`db_set_many`, run in the database thread pool
+
+        :returns: Deferred firing once the values are written
+        """
+
+        if self.write_buffer is not None:
+            self.db_set_many(collection, values, scope)
+            return self.write_buffer.flushed()
+
+        return self._db_call(self.db_set_many, collection, values, scope)
+
+
+    def db_ensure_index(self, collection, field):
+
+        """
+        Declare an index on a record field, creating it if it is missing
+
+        :param collection: Collection name ("store" or "cache").
+        :type collection: str.
+        :param field: Field name.
+        :type field: str.
+        """
+
+        key = (self._db_collection(collection), field)
+
+        if key in self.db_indexes: return
+
+        try:
+            created = self.db.ensure_index(key[0], field)
+        except Exception, e:
+            self.logger.error("Cannot index %s.%s: %s" % (key[0], field, e))
+            return
+
+        self.db_indexes.add(key)
+        self.logger.debug("%s index %s.%s" % ("Created" if created else "Verified", key[0], field))
+
+
+    def db_flush(self):
+
+        """
+        Write all buffered values now
+
+        :returns: Deferred firing once they are written
+        """
+
+        if self.write_buffer is None:
+            return defer.succeed(None)
+
+        return self.write_buffer.flush()
+
+
+    def db_stats(self):
+
+        """
+        Persistence statistics
+
+        :returns: dict
+        """
+
+        stats = dict()
+
+        if self.write_buffer is not None:
+            stats["write_buffer"] = self.write_buffer.stats()
+
+        if self.read_cache is not None:
+            stats["read_cache"] = self.read_cache.stats()
+
+        return stats
+
+
+    def _db_reconfigure(self, tags, detail):
+
+        """
+        Drop all cached records when a reconfiguration is requested
+        """
+
+        self.read_cache.invalidate()
+
+
+    def _db_write(self, records):
+
+        """
+        Write a batch of buffered values in the database thread pool
+
+        Cached copies of the records are dropped once the write completes, so
+        a read that raced with the write cannot keep serving the old value.
+        """
+
+        d = self._db_call(self._db_upsert, records)
+
+        if self.read_cache is not None:
+            d.addBoth(self._db_written, records)
+
+        return d
+
+
+    def _db_written(self, result, records):
+
+        """
+        Invalidate cached copies of written records
+        """
+
+        for key, value in records:
+            self.read_cache.invalidate(key)
+
+        return result
+
+
+    def _db_upsert(self, records):
+
+        """
+        Upsert ((collection, scoped name), value) records, one bulk write per
+        collection
+        """
+
+        grouped = dict()
+
+        for (collection, db_name), value in records:
+            grouped.setdefault(self._db_collection(collection), list()).append((db_name, value))
+
+        for collection, values in grouped.iteritems():
+            self.db.set_many(collection, values)
+
+
+    def _db_call(self, func, *args, **kwargs):
+
+        """
+        Run a blocking database call in the database thread pool
+        """
+
+        return threads.deferToThreadPool(self.reactor or reactor, self.db_pool,
+                                         func, *args, **kwargs)
+
+
+    def db_failed(self, failure, name):
+
+        """
+        Errback logging a failed background database call
+
+        :param failure: Failure.
+        :type failure: twisted.python.failure.Failure.
+        :param name: Record name (for the log message).
+        :type name: str.
+        """
+
+        self.logger.error("Database call for '%s' failed: %s" % (name, failure.getErrorMessage()))
+
+
+    def _db_timed(self, collection, query, start):
+
+        """
+        Log a query that was slow and not covered by a declared index
+        """
+
+        elapsed = time.time() - start
+
+        if elapsed < self.slow_query: return
+
+        collection = self._db_collection(collection)
+
+        if isinstance(query, basestring): return
+
+        for field in query:
+            if field == "_id" or (collection, field) in self.db_indexes:
+                return
+
+        self.logger.warn("Slow un-indexed query on %s: %r (%.3fs)" % (collection, query, elapsed))
+
+
+    def _db_collection(self, collection):
+
+        """
+        Get the backend collection name ("store" or "cache", the default)
+        """
+
+        return collection if collection in DB_COLLECTIONS else "cache"
 
 
     def _db_name(self, name, scope="service"):
@@ -305,11 +1386,25 @@ class BaseService(Service):
         Start the main Twisted service handler.
         """
 
-
-        service.Service.startService(self)
+        Service.startService(self)
         self.logger.info("Service started")
 
 
+    def stopService(self):
+
+        """
+        Stop the main Twisted service handler, flushing buffered writes.
+        """
+
+        Service.stopService(self)
+
+        d = self.db_flush()
+        d.addErrback(self.db_failed, "buffered writes")
+        d.addCallback(lambda _: self.logger.info("Service stopped"))
+
+        return d
+
+
 class MHubService(BaseService):
 
     """ MHub Twisted Service """
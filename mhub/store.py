@@ -0,0 +1,981 @@
+"""
+
+MHub Store Module
+
+.. module:: store
+   :platform: Unix
+   :synopsis: MHub persistence helpers
+
+.. moduleauthor:: JingleManSweep <jinglemansweep@gmail.com>
+
+"""
+
+import copy
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from twisted.internet import defer
+from twisted.python.threadable import isInIOThread
+
+try:
+    import pymongo
+except ImportError:
+    pymongo = None
+else:
+    from bson.errors import InvalidId
+    from bson.objectid import ObjectId
+    from pymongo.errors import ConnectionFailure
+
+
+class WriteBuffer(object):
+
+    """
+    Write-behind buffer for record writes.
+
+    Writes are keyed by (collection, scoped name); a newer write to a key that
+    is still pending replaces the older value, so only the latest value of each
+    record is written. Pending writes are handed to ``write`` as one batch
+    when the flush interval expires or the number of pending records reaches
+    ``size``, whichever comes first.
+
+    Flushed records stay readable through :meth:`get` until their write has
+    completed, and each flush waits for the previous one, so batches are
+    written in order and a read never falls back to an older stored value.
+
+    Values are copied in and out, so later changes to the caller's object
+    do not alter what is written.
+
+    Writes may be buffered from any thread; flushing always happens on the
+    reactor thread.
+
+    :param reactor: Twisted Reactor object
+    :type reactor: twisted.internet.reactor
+    :param write: Called with a list of ((collection, name), value) pairs;
+                  returns a Deferred firing once they are stored.
+    :type write: function.
+    :param interval: Seconds to hold writes before flushing.
+    :type interval: float.
+    :param size: Number of pending records that triggers an early flush.
+    :type size: int.
+    """
+
+    def __init__(self, reactor, write, interval=1.0, size=500):
+
+        """ Constructor """
+
+        self.reactor = reactor
+        self.write = write
+        self.interval = interval
+        self.size = size
+        self.pending = OrderedDict()
+        self.inflight = dict()
+        self.waiting = list()
+        self.timer = None
+        self.tail = defer.succeed(None)
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.written = 0
+        self.logger = logging.getLogger("store")
+
+
+    def put(self, key, value):
+
+        """
+        Buffer a record write.
+
+        :param key: (collection, scoped name) pair.
+        :type key: tuple.
+        :param value: Value to store (copied, so the caller may keep
+                      modifying it).
+        """
+
+        value = copy.deepcopy(value)
+
+        with self.lock:
+            self.writes += 1
+            if key in self.pending:
+                self.coalesced += 1
+                del self.pending[key]
+            self.pending[key] = value
+            full = len(self.pending) >= self.size
+
+        if isInIOThread():
+            self._wake(full)
+        else:
+            self.reactor.callFromThread(self._wake, full)
+
+
+    def get(self, key, default=None):
+
+        """
+        Get the buffered value of a record, if it has not been written yet.
+
+        :param key: (collection, scoped name) pair.
+        :type key: tuple.
+        :param default: Returned when no write is pending or in flight.
+        """
+
+        with self.lock:
+            if key in self.pending:
+                value = self.pending[key]
+            elif key in self.inflight:
+                value = self.inflight[key][1]
+            else:
+                return default
+
+        return copy.deepcopy(value)
+
+
+    def __contains__(self, key):
+
+        with self.lock:
+            return key in self.pending or key in self.inflight
+
+
+    def flushed(self):
+
+        """
+        Get a Deferred firing once the currently pending writes are stored.
+
+        :returns: Deferred
+        """
+
+        d = defer.Deferred()
+        self.waiting.append(d)
+
+        return d
+
+
+    def flush(self):
+
+        """
+        Write all pending records now, once any earlier flush has completed.
+
+        :returns: Deferred firing once they are stored.
+        """
+
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+        with self.lock:
+            records, self.pending = self.pending.items(), OrderedDict()
+            if records:
+                self.flushes += 1
+                self.written += len(records)
+                for key, value in records:
+                    self.inflight[key] = (self.flushes, value)
+            batch = self.flushes
+
+        waiting, self.waiting = self.waiting, list()
+
+        d = defer.Deferred()
+        self.tail.addBoth(self._write, records, batch).chainDeferred(d)
+
+        def _done(result):
+            for waiter in waiting:
+                waiter.callback(None)
+            return result
+
+        def _failed(failure):
+            for waiter in waiting:
+                waiter.errback(failure)
+            return failure
+
+        d.addCallbacks(_done, _failed)
+
+        return d
+
+
+    def stats(self):
+
+        """
+        Buffer statistics.
+
+        :returns: dict
+        """
+
+        return dict(writes=self.writes,
+                    coalesced=self.coalesced,
+                    flushes=self.flushes,
+                    written=self.written,
+                    pending=len(self.pending),
+                    inflight=len(self.inflight))
+
+
+    def _write(self, ignored, records, batch):
+
+        if not records: return
+
+        self.logger.debug("Flushing %i buffered writes" % (len(records)))
+
+        d = defer.maybeDeferred(self.write, records)
+        d.addBoth(self._written, records, batch)
+
+        return d
+
+
+    def _written(self, result, records, batch):
+
+        with self.lock:
+            for key, value in records:
+                if self.inflight.get(key, (None, None))[0] == batch:
+                    del self.inflight[key]
+
+        return result
+
+
+    def _wake(self, full):
+
+        if full:
+            self.flush().addErrback(self._flush_failed)
+        elif self.timer is None and self.pending:
+            self.timer = self.reactor.callLater(self.interval, self._expired)
+
+
+    def _expired(self):
+
+        self.timer = None
+        self.flush().addErrback(self._flush_failed)
+
+
+    def _flush_failed(self, failure):
+
+        self.logger.error("Failed to flush buffered writes: %s" % (failure.getErrorMessage()))
+
+
+class RecordCache(object):
+
+    """
+    Thread-safe LRU cache of record values with a time-to-live.
+
+    Values are copied in and out, so callers may modify what they get back
+    without changing the cached value.
+
+    Reads that race with an invalidation cannot repopulate the cache with the
+    value they read: take a :meth:`token` before reading from the database
+    and pass it to :meth:`put`, which ignores it if anything was invalidated
+    in between.
+
+    :param size: Maximum number of cached records.
+    :type size: int.
+    :param ttl: Seconds a cached value stays valid (0 for no expiry).
+    :type ttl: float.
+    :param clock: Function returning the current time in seconds.
+    :type clock: function.
+    """
+
+    def __init__(self, size=1000, ttl=60.0, clock=time.time):
+
+        """ Constructor """
+
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key):
+
+        """
+        Look up a record.
+
+        :param key: (collection, scoped name) pair.
+        :type key: tuple.
+        :returns: tuple -- (hit, value)
+        """
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and (not self.ttl or entry[0] > self.clock()):
+                self.entries[key] = entry
+                self.hits += 1
+                return True, copy.deepcopy(entry[1])
+            self.misses += 1
+            return False, None
+
+
+    def token(self):
+
+        """
+        Get the current invalidation generation (see :meth:`put`).
+
+        :returns: int
+        """
+
+        return self.generation
+
+
+    def put(self, key, value, token=None):
+
+        """
+        Cache a record value.
+
+        :param key: (collection, scoped name) pair.
+        :type key: tuple.
+        :param value: Value read from the database.
+        :param token: Generation from :meth:`token` taken before the read.
+        :type token: int.
+        """
+
+        with self.lock:
+            if token is not None and token != self.generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (self.clock() + self.ttl, copy.deepcopy(value))
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def invalidate(self, key=None):
+
+        """
+        Drop a cached record, or every record if no key is given.
+
+        :param key: (collection, scoped name) pair.
+        :type key: tuple.
+        """
+
+        with self.lock:
+            self.generation += 1
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+
+    def stats(self):
+
+        """
+        Cache statistics.
+
+        :returns: dict
+        """
+
+        return dict(size=len(self.entries),
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions)
+
+
+class RecentSet(object):
+
+    """
+    Time-windowed set for de-duplicating feed items.
+
+    Keys are kept in ``generations`` buckets, each covering an equal slice of
+    the window; a new bucket replaces the oldest as time moves on, so memory
+    is bounded by the item rate and membership tests are a few set lookups.
+    A key is remembered for at least ``window * (generations - 1) /
+    generations`` seconds and at most ``window`` seconds.
+
+    Buckets map onto a fixed set of slots, so the set can be persisted
+    incrementally: :meth:`changes` returns only the slots modified since it
+    was last called, to be stored as records and passed back to
+    :meth:`restore` on startup.
+
+    :param window: Seconds keys are remembered for.
+    :type window: float.
+    :param generations: Number of buckets.
+    :type generations: int.
+    :param clock: Function returning the current time in seconds.
+    :type clock: function.
+    """
+
+    def __init__(self, window=86400, generations=4, clock=time.time):
+
+        """ Constructor """
+
+        self.window = window
+        self.generations = generations
+        self.span = float(window) / generations
+        self.clock = clock
+        self.buckets = [(None, set()) for slot in xrange(generations)]
+        self.dirty = set()
+
+
+    def add(self, key):
+
+        """
+        Add a key.
+
+        :param key: Item key (hashable; persisted sets need JSON-friendly keys).
+        :returns: bool -- False if the key was already present.
+        """
+
+        generation = self._rotate()
+
+        if self._contains(key): return False
+
+        slot = generation % self.generations
+        self.buckets[slot][1].add(key)
+        self.dirty.add(slot)
+
+        return True
+
+
+    def __contains__(self, key):
+
+        self._rotate()
+
+        return self._contains(key)
+
+
+    def __len__(self):
+
+        self._rotate()
+
+        return sum(len(keys) for generation, keys in self.buckets)
+
+
+    def changes(self):
+
+        """
+        Get the slots modified since the last call.
+
+        :returns: dict -- {slot: {"generation": int, "keys": list}}
+        """
+
+        dirty, self.dirty = self.dirty, set()
+
+        return dict((slot, dict(generation=self.buckets[slot][0],
+                                keys=list(self.buckets[slot][1])))
+                    for slot in dirty)
+
+
+    def restore(self, slots):
+
+        """
+        Merge persisted slots (see :meth:`changes`), ignoring expired ones.
+
+        :param slots: {slot: {"generation": int, "keys": list}}
+        :type slots: dict.
+        """
+
+        current = self._rotate()
+
+        for slot, state in slots.iteritems():
+            if not state: continue
+            slot = int(slot)
+            generation = state.get("generation")
+            if generation is None or generation <= current - self.generations:
+                continue
+            if generation % self.generations != slot:
+                continue
+            if self.buckets[slot][0] == generation:
+                self.buckets[slot][1].update(state.get("keys", list()))
+            elif self.buckets[slot][0] is None or self.buckets[slot][0] < generation:
+                self.buckets[slot] = (generation, set(state.get("keys", list())))
+
+
+    def _contains(self, key):
+
+        for generation, keys in self.buckets:
+            if key in keys: return True
+
+        return False
+
+
+    def _rotate(self):
+
+        generation = int(self.clock() // self.span)
+        slot = generation % self.generations
+
+        if self.buckets[slot][0] != generation:
+            for index, (old, keys) in enumerate(self.buckets):
+                if old is not None and old <= generation - self.generations:
+                    self.buckets[index] = (None, set())
+            if self.buckets[slot][0] != generation:
+                self.buckets[slot] = (generation, set())
+                self.dirty.add(slot)
+
+        return generation
+
+
+SQL_VARIABLES = 500
+
+FIELD_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class StoreError(Exception):
+
+    """
+    Raised when a storage backend cannot be opened.
+    """
+
+    pass
+
+
+def match(record, query):
+
+    """
+    Check whether a record matches a simple query.
+
+    Queries are dictionaries of field values which must all be equal (as in
+    MongoDB, a list field also matches any one of its items). A value of
+    ``{"$in": [...]}`` matches any of the listed values.
+
+    :param record: Record dictionary.
+    :type record: dict.
+    :param query: Query dictionary.
+    :type query: dict.
+    :returns: bool
+    """
+
+    for field, expected in query.iteritems():
+        actual = record.get(field, _ABSENT)
+        if isinstance(expected, dict) and "$in" in expected:
+            if actual in expected["$in"]:
+                continue
+            if isinstance(actual, list) and any(a in expected["$in"] for a in actual):
+                continue
+            return False
+        if actual == expected:
+            continue
+        if isinstance(actual, list) and expected in actual:
+            continue
+        return False
+
+    return True
+
+
+_ABSENT = object()
+
+
+class BaseStore(object):
+
+    """
+    Storage backend interface.
+
+    Backends hold named collections ("store" and "cache") of records
+    (dictionaries). Key/value records look like ``{"name": ..., "value": ...}``;
+    other records may hold any fields. All methods block, so the service
+    calls them from its database thread pool.
+    """
+
+    def find(self, collection, query, fields=None, sort=None, limit=None,
+             after=None):
+
+        """
+        Find records matching a query.
+
+        :param collection: Collection name.
+        :type collection: str.
+        :param query: Query dictionary (see :func:`match`).
+        :type query: dict.
+        :param fields: Fields to return (``_id`` is always included).
+        :type fields: list.
+        :param sort: (field, direction) pairs, direction 1 or -1.
+        :type sort: list.
+        :param limit: Maximum number of records.
+        :type limit: int.
+        :param after: Only records whose ``_id`` sorts after this one (for
+                      paging in ``_id`` order).
+        :returns: iterable of records
+        """
+
+        raise NotImplementedError
+
+
+    def find_one(self, collection, query):
+
+        """
+        Find the first record matching a query, or a record by id string.
+
+        :param collection: Collection name.
+        :type collection: str.
+        :param query: Query dictionary or record id.
+        :type query: dict.
+        :returns: dict or None
+        """
+
+        raise NotImplementedError
+
+
+    def get(self, collection, name):
+
+        """
+        Get a key/value record by name.
+
+        :param collection: Collection name.
+        :type collection: str.
+        :param name: Scoped record name.
+        :type name: str.
+        :returns: dict or None
+        """
+
+        return self.find_one(collection, {"name": name})
+
+
+    def get_many(self, collection, names):
+
+        """
+        Get several key/value records by name at once.
+
+        :param collection: Collection name.
+        :type collection: str.
+        :param names: Scoped record names.
+        :type names: list.
+        :returns: dict -- records by name (missing names are left out)
+        """
+
+        return dict((record["name"], record)
+                    for record in self.find(collection, {"name": {"$in": list(names)}}))
+
+
+    def set(self, collection, name, value):
+
+        """
+        Insert or replace a key/value record.
+
+        :param collection: Collection name.
+        :type collection: str.
+        :param name: Scoped record name.
+        :type name: str.
+        :param value: Value to store.
+        """
+
+        self.set_many(collection, [(name, value)])
+
+
+    def set_many(self, collection, values):
+
+        """
+        Insert or replace several key/value records at once.
+
+        :param collection: Collection name.
+        :type collection: str.
+        :param values: (name, value) pairs.
+        :type values: list.
+        """
+
+        raise NotImplementedError
+
+
+    def ensure_index(self, collection, field):
+
+        """
+        Create an index on a record field unless it already exists.
+
+        :param collection: Collection name.
+        :type collection: str.
+        :param field: Field name.
+        :type field: str.
+        :returns: bool -- True if the index was created.
+        """
+
+        raise NotImplementedError
+
+
+    def close(self):
+
+        """
+        Release the backend's connections.
+        """
+
+        pass
+
+
+class MongoStore(BaseStore):
+
+    """
+    MongoDB storage backend.
+
+    :param host: Server host.
+    :type host: str.
+    :param port: Server port.
+    :type port: int.
+    :param database: Database name.
+    :type database: str.
+    """
+
+    def __init__(self, host="localhost", port=27017, database="mhub"):
+
+        """ Constructor """
+
+        if pymongo is None:
+            raise StoreError("The mongo store requires the pymongo package")
+
+        try:
+            self.connection = pymongo.Connection(host, port)
+        except ConnectionFailure, e:
+            raise StoreError("Cannot connect to MongoDB at %s:%i (%s)" % (host, port, e))
+
+        self.db = self.connection[database]
+
+
+    def find(self, collection, query, fields=None, sort=None, limit=None,
+             after=None):
+
+        if after is not None:
+            query = dict(query)
+            try:
+                query["_id"] = {"$gt": ObjectId(after)}
+            except (InvalidId, TypeError):
+                query["_id"] = {"$gt": after}
+
+        cursor = self.db[collection].find(query, fields)
+
+        if sort:
+            cursor = cursor.sort(sort)
+
+        if limit:
+            cursor = cursor.limit(limit)
+
+        return cursor
+
+
+    def find_one(self, collection, query):
+
+        if isinstance(query, basestring):
+            query = ObjectId(query)
+
+        return self.db[collection].find_one(query)
+
+
+    def set_many(self, collection, values):
+
+        db_collection = self.db[collection]
+
+        if len(values) > 1 and hasattr(db_collection, "initialize_unordered_bulk_op"):
+            bulk = db_collection.initialize_unordered_bulk_op()
+            for name, value in values:
+                bulk.find({"name": name}).upsert().replace_one({"name": name, "value": value})
+            bulk.execute()
+            return
+
+        for name, value in values:
+            db_collection.update({"name": name}, {"name": name, "value": value}, upsert=True)
+
+
+    def ensure_index(self, collection, field):
+
+        db_collection = self.db[collection]
+
+        for info in db_collection.index_information().itervalues():
+            if info.get("key") == [(field, 1)]:
+                return False
+
+        db_collection.ensure_index(field)
+
+        return True
+
+
+    def close(self):
+
+        self.connection.disconnect()
+
+
+class SqliteStore(BaseStore):
+
+    """
+    Embedded SQLite storage backend (no database server required).
+
+    Records are stored as JSON documents in a single table keyed by collection
+    and name, in a write-ahead-logged database file. Each thread gets its own
+    connection. Key/value records use their name as ``_id``; other records
+    get a generated one, which :meth:`find_one` accepts in place of a query
+    (as with MongoDB ObjectIds). Queries on ``name`` use the primary key and
+    queries on an indexed field (see :meth:`ensure_index`) use its index;
+    other fields are matched in Python.
+
+    :param path: Database file path.
+    :type path: str.
+    """
+
+    def __init__(self, path):
+
+        """ Constructor """
+
+        directory = os.path.dirname(path)
+
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.local = threading.local()
+        self.indexed = set()
+
+        try:
+            db = self.connection()
+            db.execute("CREATE TABLE IF NOT EXISTS records ("
+                       "collection TEXT NOT NULL, "
+                       "name TEXT NOT NULL, "
+                       "doc TEXT NOT NULL, "
+                       "PRIMARY KEY (collection, name))")
+            db.commit()
+        except sqlite3.Error, e:
+            raise StoreError("Cannot open SQLite store '%s' (%s)" % (path, e))
+
+
+    def connection(self):
+
+        """
+        Get this thread's connection, opening it on first use.
+
+        :returns: sqlite3.Connection
+        """
+
+        db = getattr(self.local, "db", None)
+
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+
+        return db
+
+
+    def find(self, collection, query, fields=None, sort=None, limit=None,
+             after=None):
+
+        query = dict(query or dict())
+        name = query.get("name")
+
+        if isinstance(name, dict) and name.keys() == ["$in"] and len(query) == 1 \
+                and not (fields or sort or limit or after is not None):
+            return self.get_many(collection, name["$in"]).values()
+
+        where = ["collection = ?"]
+        params = [collection]
+
+        if isinstance(name, basestring):
+            where.append("name = ?")
+            params.append(query.pop("name"))
+        else:
+            for field, value in query.items():
+                if field in self.indexed and isinstance(value, (basestring, int, long, float)):
+                    where.append("json_extract(doc, '$.%s') = ?" % (field))
+                    params.append(query.pop(field))
+                    break
+
+        if after is not None:
+            where.append("json_extract(doc, '$._id') > ?")
+            params.append(after)
+
+        order = list()
+
+        for field, direction in sort or list():
+            if not FIELD_NAME.match(field):
+                raise ValueError("Cannot sort by field '%s'" % (field))
+            order.append("json_extract(doc, '$.%s') %s" % (field, "DESC" if direction < 0 else "ASC"))
+
+        sql = "SELECT doc FROM records WHERE %s ORDER BY %s" % (
+            " AND ".join(where), ", ".join(order) or "rowid")
+
+        if limit and not query:
+            sql += " LIMIT %i" % (limit)
+
+        rows = self.connection().execute(sql, params)
+        records = (json.loads(row[0]) for row in rows)
+
+        if query:
+            records = [record for record in records if match(record, query)]
+            if limit:
+                records = records[:limit]
+
+        if fields:
+            fields = set(fields) | set(["_id"])
+            return [dict((k, v) for k, v in record.iteritems() if k in fields)
+                    for record in records]
+
+        return list(records)
+
+
+    def find_one(self, collection, query):
+
+        if isinstance(query, basestring):
+            query = {"_id": query}
+
+        for record in self.find(collection, query):
+            return record
+
+        return None
+
+
+    def get_many(self, collection, names):
+
+        names = list(names)
+        records = dict()
+        db = self.connection()
+
+        for first in xrange(0, len(names), SQL_VARIABLES):
+            batch = names[first:first + SQL_VARIABLES]
+            rows = db.execute(
+                "SELECT doc FROM records WHERE collection = ? AND name IN (%s)" % (
+                    ", ".join("?" * len(batch))),
+                [collection] + batch)
+            for row in rows:
+                record = json.loads(row[0])
+                records[record["name"]] = record
+
+        return records
+
+
+    def set_many(self, collection, values):
+
+        db = self.connection()
+
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO records (collection, name, doc) VALUES (?, ?, ?)",
+                ((collection, name, json.dumps({"_id": name, "name": name, "value": value}))
+                 for name, value in values))
+
+
+    def ensure_index(self, collection, field):
+
+        """
+        Create an expression index on a JSON record field.
+
+        ``name`` is always indexed (it is part of the primary key). Other
+        indexes need SQLite's JSON1 functions and cover every collection.
+        """
+
+        if field == "name": return False
+
+        if not FIELD_NAME.match(field):
+            raise ValueError("Cannot index field '%s'" % (field))
+
+        db = self.connection()
+        index = "records_%s" % (field)
+        exists = db.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                            (index,)).fetchone()
+
+        if not exists:
+            with db:
+                db.execute("CREATE INDEX %s ON records (collection, json_extract(doc, '$.%s'))" % (
+                    index, field))
+
+        self.indexed.add(field)
+
+        return not exists
+
+
+    def close(self):
+
+        db = getattr(self.local, "db", None)
+
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+
+STORES = {
+    "mongo": MongoStore,
+    "sqlite": SqliteStore
+}
@@ -0,0 +1,408 @@
+"""
+
+MHub Time Series Module
+
+.. module:: timeseries
+   :platform: Unix
+   :synopsis: MHub sensor reading history with downsampled rollups
+
+.. moduleauthor:: JingleManSweep <jinglemansweep@gmail.com>
+
+"""
+
+import bisect
+import cPickle
+import logging
+import os
+
+from array import array
+
+from journal import REPLAY_ORIGIN
+
+
+RESOLUTIONS = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400
+}
+
+RETENTION = {
+    "minute": 7 * 24 * 60,
+    "hour": 365 * 24,
+    "day": 10 * 365
+}
+
+
+class Chunk(object):
+
+    """
+    Fixed capacity block of raw (timestamp, value) points.
+
+    :param size: Maximum number of points.
+    :type size: int.
+    """
+
+    __slots__ = ("size", "times", "values")
+
+    def __init__(self, size=1024):
+
+        """ Constructor """
+
+        self.size = size
+        self.times = array("d")
+        self.values = array("d")
+
+
+    def full(self):
+
+        return len(self.times) >= self.size
+
+
+    def add(self, timestamp, value):
+
+        """
+        Add a point, keeping the chunk in time order.
+        """
+
+        if not self.times or timestamp >= self.times[-1]:
+            self.times.append(timestamp)
+            self.values.append(value)
+        else:
+            position = bisect.bisect_right(self.times, timestamp)
+            self.times.insert(position, timestamp)
+            self.values.insert(position, value)
+
+
+    def range(self, start, end):
+
+        """
+        Points in a time range.
+
+        :returns: list of (timestamp, value) pairs
+        """
+
+        first = bisect.bisect_left(self.times, start)
+        last = bisect.bisect_left(self.times, end)
+
+        return zip(self.times[first:last], self.values[first:last])
+
+
+class Rollup(object):
+
+    """
+    Incrementally maintained min/max/avg aggregates over fixed time buckets.
+
+    Buckets are held in parallel arrays ordered by start time; points for the
+    newest bucket are an append or an in-place update, older buckets are
+    found by bisection.
+
+    :param width: Bucket width in seconds.
+    :type width: int.
+    :param retention: Maximum number of buckets kept.
+    :type retention: int.
+    """
+
+    def __init__(self, width, retention):
+
+        """ Constructor """
+
+        self.width = width
+        self.retention = retention
+        self.starts = array("d")
+        self.mins = array("d")
+        self.maxs = array("d")
+        self.sums = array("d")
+        self.counts = array("L")
+
+
+    def add(self, timestamp, value):
+
+        """
+        Fold a point into its bucket.
+
+        Points older than the retained buckets are dropped.
+        """
+
+        start = timestamp - timestamp % self.width
+        starts = self.starts
+
+        if starts and starts[-1] == start:
+            position = len(starts) - 1
+        else:
+            if len(starts) >= self.retention and start < starts[0]:
+                return
+            position = bisect.bisect_left(starts, start)
+            if position == len(starts) or starts[position] != start:
+                starts.insert(position, start)
+                self.mins.insert(position, value)
+                self.maxs.insert(position, value)
+                self.sums.insert(position, 0.0)
+                self.counts.insert(position, 0)
+                self._trim()
+                position = bisect.bisect_left(starts, start)
+                if position == len(starts) or starts[position] != start:
+                    return
+
+        if value < self.mins[position]: self.mins[position] = value
+        if value > self.maxs[position]: self.maxs[position] = value
+        self.sums[position] += value
+        self.counts[position] += 1
+
+
+    def range(self, start, end):
+
+        """
+        Buckets starting in a time range.
+
+        :returns: list of dictionaries (t, min, max, avg, count)
+        """
+
+        first = bisect.bisect_left(self.starts, start - start % self.width)
+        last = bisect.bisect_left(self.starts, end)
+
+        return [dict(t=self.starts[i],
+                     min=self.mins[i],
+                     max=self.maxs[i],
+                     avg=self.sums[i] / self.counts[i],
+                     count=self.counts[i])
+                for i in xrange(first, last)]
+
+
+    def _trim(self):
+
+        excess = len(self.starts) - self.retention
+
+        if excess > self.retention // 10:
+            for column in (self.starts, self.mins, self.maxs, self.sums, self.counts):
+                del column[:excess]
+
+
+class Series(object):
+
+    """
+    History of one measurement from one sensor.
+
+    :param chunk_size: Points per raw chunk.
+    :type chunk_size: int.
+    :param raw_points: Number of raw points kept (older chunks are dropped).
+    :type raw_points: int.
+    """
+
+    def __init__(self, chunk_size=1024, raw_points=10080):
+
+        """ Constructor """
+
+        self.chunk_size = chunk_size
+        self.raw_points = raw_points
+        self.chunks = list()
+        self.rollups = dict((name, Rollup(width, RETENTION[name]))
+                            for name, width in RESOLUTIONS.iteritems())
+
+
+    def add(self, timestamp, value):
+
+        """
+        Record a reading.
+
+        :param timestamp: Reading time (seconds since the epoch).
+        :type timestamp: float.
+        :param value: Reading.
+        :type value: float.
+        """
+
+        chunks = self.chunks
+
+        if chunks and timestamp < chunks[-1].times[0]:
+            position = max(0, bisect.bisect_right([c.times[0] for c in chunks], timestamp) - 1)
+            chunks[position].add(timestamp, value)
+        else:
+            if not chunks or chunks[-1].full():
+                chunks.append(Chunk(self.chunk_size))
+                if len(chunks) * self.chunk_size > self.raw_points + self.chunk_size:
+                    del chunks[0]
+            chunks[-1].add(timestamp, value)
+
+        for rollup in self.rollups.itervalues():
+            rollup.add(timestamp, value)
+
+
+    def raw(self, start, end):
+
+        """
+        Raw readings in a time range.
+
+        :returns: list of (timestamp, value) pairs
+        """
+
+        points = list()
+
+        for chunk in self.chunks:
+            if chunk.times[-1] < start: continue
+            if chunk.times[0] >= end: break
+            points.extend(chunk.range(start, end))
+
+        return points
+
+
+    def query(self, start, end, resolution="auto", max_points=1000):
+
+        """
+        Readings in a time range, raw or rolled up.
+
+        :param start: Range start (seconds since the epoch).
+        :type start: float.
+        :param end: Range end (exclusive).
+        :type end: float.
+        :param resolution: "raw", "minute", "hour", "day" or "auto" (the
+                           finest rollup giving at most ``max_points``).
+        :type resolution: str.
+        :returns: tuple -- (resolution, points)
+        """
+
+        if resolution == "auto":
+            resolution = "day"
+            for name in sorted(RESOLUTIONS, key=RESOLUTIONS.get):
+                if (end - start) / RESOLUTIONS[name] <= max_points:
+                    resolution = name
+                    break
+
+        if resolution == "raw":
+            return resolution, [dict(t=t, value=v) for t, v in self.raw(start, end)]
+
+        return resolution, self.rollups[resolution].range(start, end)
+
+
+class TimeSeriesStore(object):
+
+    """
+    In-memory time series of numeric sensor readings.
+
+    Readings are taken from status events: the sensor is the publishing
+    plugin (its "n:" tag) and every numeric detail field is a measurement.
+
+    :param chunk_size: Points per raw chunk.
+    :type chunk_size: int.
+    :param raw_points: Raw points kept per series.
+    :type raw_points: int.
+    """
+
+    def __init__(self, chunk_size=1024, raw_points=10080):
+
+        """ Constructor """
+
+        self.chunk_size = chunk_size
+        self.raw_points = raw_points
+        self.series = dict()
+        self.readings = 0
+        self.logger = logging.getLogger("timeseries")
+
+
+    def record(self, event):
+
+        """
+        Record the numeric fields of a status event (subscription callback).
+
+        :param event: Status event.
+        :type event: bus.Event.
+        """
+
+        if event.origin == REPLAY_ORIGIN: return
+
+        if not isinstance(event.detail, dict): return
+
+        sensor = event.origin
+
+        for tag in event.tags:
+            if tag.startswith("n:"):
+                sensor = tag[2:]
+                break
+
+        for measurement, value in event.detail.iteritems():
+            if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+                continue
+            self.add(sensor, measurement, event.timestamp, float(value))
+
+
+    def add(self, sensor, measurement, timestamp, value):
+
+        """
+        Record a reading.
+
+        :param sensor: Sensor name.
+        :type sensor: str.
+        :param measurement: Measurement name (e.g. "temperature").
+        :type measurement: str.
+        :param timestamp: Reading time (seconds since the epoch).
+        :type timestamp: float.
+        :param value: Reading.
+        :type value: float.
+        """
+
+        key = (sensor, measurement)
+        series = self.series.get(key)
+
+        if series is None:
+            series = self.series[key] = Series(self.chunk_size, self.raw_points)
+
+        series.add(timestamp, value)
+        self.readings += 1
+
+
+    def query(self, sensor, measurement, start, end, resolution="auto"):
+
+        """
+        Readings of one series in a time range (see :meth:`Series.query`).
+
+        :returns: tuple -- (resolution, points)
+        """
+
+        series = self.series.get((sensor, measurement))
+
+        if series is None:
+            return resolution, list()
+
+        return series.query(start, end, resolution)
+
+
+    def names(self):
+
+        """
+        Recorded (sensor, measurement) pairs.
+
+        :returns: list
+        """
+
+        return sorted(self.series)
+
+
+    def save(self, path):
+
+        """
+        Write all series to a file.
+
+        :param path: File path.
+        :type path: str.
+        """
+
+        with open(path + ".tmp", "wb") as f:
+            cPickle.dump(self.series, f, cPickle.HIGHEST_PROTOCOL)
+
+        os.rename(path + ".tmp", path)
+
+
+    def load(self, path):
+
+        """
+        Read series saved by :meth:`save`, if the file exists.
+
+        :param path: File path.
+        :type path: str.
+        """
+
+        if not os.path.exists(path): return
+
+        try:
+            with open(path, "rb") as f:
+                self.series = cPickle.load(f)
+        except Exception, e:
+            self.logger.warn("Could not load time series from '%s': %s" % (path, e))
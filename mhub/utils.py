@@ -85,6 +85,46 @@ def generate_default(config_dir,
             "cache_dir": cache_dir,
             "verbose": False,
         },
+        "db": {
+            "backend": "mongo",
+            "path": None,
+            "threads": 4,
+            "write_interval": 1.0,
+            "write_batch": 500,
+            "cache_size": 1000,
+            "cache_ttl": 60.0,
+            "slow_query": 0.1
+        },
+        "journal": {
+            "enabled": False,
+            "path": None,
+            "segment_size": 64 * 1024 * 1024,
+            "segments": 0,
+            "flush_interval": 0.5,
+            "format": "json"
+        },
+        "timeseries": {
+            "enabled": True,
+            "query": "o:status",
+            "path": None,
+            "raw_points": 10080,
+            "save_interval": 300
+        },
+        "bus": {
+            "dispatch": "sync",
+            "queue_size": 1000,
+            "overflow": "drop_oldest",
+            "drain_batch": 100,
+            "thread_pool_size": 4,
+            "process_workers": None,
+            "coalesce": [],
+            "limits": [],
+            "max_hops": 8,
+            "priorities": {
+                "i:switch": "high",
+                "i:command": "high"
+            }
+        },
         "amqp": {
             "host": "localhost",
             "port": 5672,
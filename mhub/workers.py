@@ -0,0 +1,328 @@
+"""
+
+MHub Worker Processes Module
+
+.. module:: workers
+   :platform: Unix
+   :synopsis: MHub process pool for CPU-bound plugin work
+
+.. moduleauthor:: JingleManSweep <jinglemansweep@gmail.com>
+
+"""
+
+import cPickle
+import itertools
+import logging
+import multiprocessing
+import os
+import struct
+import sys
+import traceback
+
+from twisted.internet import defer, protocol
+
+
+HEADER = struct.Struct("!I")
+
+WORKER_SCRIPT = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+
+
+class WorkerError(Exception):
+
+    """
+    Raised (via errback) when a worker call fails or its worker dies.
+    """
+
+    pass
+
+
+def resolve(path):
+
+    """
+    Import a function from a "module:function" path.
+
+    :param path: Function path, e.g. "plugins.http:find_patterns".
+    :type path: str.
+    :returns: function
+    """
+
+    module_name, _, func_name = path.partition(":")
+    module = __import__(module_name, fromlist=[func_name])
+
+    return getattr(module, func_name)
+
+
+def frame(obj):
+
+    """
+    Pickle an object into a length-prefixed frame.
+
+    :param obj: Object to send.
+    :returns: str
+    """
+
+    payload = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+
+    return HEADER.pack(len(payload)) + payload
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+
+    """
+    Hub side of the pipe to a single worker process.
+
+    :param pool: Owning process pool.
+    :type pool: ProcessPool.
+    :param index: Worker slot number.
+    :type index: int.
+    """
+
+    def __init__(self, pool, index):
+
+        """ Constructor """
+
+        self.pool = pool
+        self.index = index
+        self.pending = dict()
+        self.buffer = ""
+        self.logger = logging.getLogger("workers")
+
+
+    def call(self, request_id, path, args, d):
+
+        """
+        Send a call to the worker.
+
+        The arguments are pickled before the call is registered, so a call
+        that cannot be sent raises here and leaves nothing pending.
+        """
+
+        data = frame((request_id, path, cPickle.dumps(args, cPickle.HIGHEST_PROTOCOL)))
+
+        self.pending[request_id] = d
+        self.transport.write(data)
+
+
+    def outReceived(self, data):
+
+        """
+        Parse result frames from the worker's stdout.
+        """
+
+        self.buffer += data
+
+        while len(self.buffer) >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer)
+            end = HEADER.size + length
+            if len(self.buffer) < end: break
+            payload = self.buffer[HEADER.size:end]
+            self.buffer = self.buffer[end:]
+            request_id, ok, result = cPickle.loads(payload)
+            d = self.pending.pop(request_id, None)
+            if d is None: continue
+            if ok:
+                d.callback(result)
+            else:
+                d.errback(WorkerError(result))
+
+
+    def errReceived(self, data):
+
+        """
+        Log anything the worker writes to stderr.
+        """
+
+        self.logger.debug("Worker %i: %s" % (self.index, data.rstrip()))
+
+
+    def processEnded(self, reason):
+
+        """
+        Fail in-flight calls and ask the pool to restart the worker.
+        """
+
+        pending, self.pending = self.pending, dict()
+
+        for d in pending.itervalues():
+            d.errback(WorkerError("Worker %i exited" % (self.index)))
+
+        self.pool.worker_ended(self, reason)
+
+
+class ProcessPool(object):
+
+    """
+    Pool of worker processes for CPU-bound work.
+
+    Calls name a module-level function by "module:function" path; arguments
+    and results are pickled over each worker's stdin/stdout pipe, so they must
+    be picklable and the function must not rely on hub state. Calls go to the
+    least busy worker and crashed workers are restarted after a short delay.
+
+    :param reactor: Twisted Reactor object
+    :type reactor: twisted.internet.reactor
+    :param size: Number of workers (defaults to the number of CPUs).
+    :type size: int.
+    :param restart_delay: Seconds to wait before restarting a dead worker.
+    :type restart_delay: float.
+    :param path: Directory added to the workers' PYTHONPATH.
+    :type path: str.
+    """
+
+    def __init__(self, reactor, size=None, restart_delay=1.0, path=None):
+
+        """ Constructor """
+
+        self.reactor = reactor
+        self.size = size or multiprocessing.cpu_count()
+        self.restart_delay = restart_delay
+        self.path = path or os.path.dirname(os.path.abspath(__file__))
+        self.workers = [None] * self.size
+        self.running = False
+        self.restarts = 0
+        self._ids = itertools.count()
+        self.logger = logging.getLogger("workers")
+
+
+    def start(self):
+
+        """
+        Spawn all workers.
+        """
+
+        self.running = True
+
+        for index in xrange(self.size):
+            self.spawn(index)
+
+        self.logger.info("Started %i worker processes" % (self.size))
+
+
+    def stop(self):
+
+        """
+        Stop all workers by closing their stdin.
+        """
+
+        self.running = False
+
+        for worker in self.workers:
+            if worker is not None and worker.transport is not None:
+                worker.transport.closeStdin()
+
+
+    def spawn(self, index):
+
+        """
+        Spawn (or respawn) the worker in a slot.
+
+        :param index: Worker slot number.
+        :type index: int.
+        """
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [self.path, env.get("PYTHONPATH")]))
+
+        worker = WorkerProtocol(self, index)
+        self.reactor.spawnProcess(worker, sys.executable,
+                                  [sys.executable, WORKER_SCRIPT],
+                                  env=env)
+        self.workers[index] = worker
+
+
+    def worker_ended(self, worker, reason):
+
+        """
+        Handle a worker exit, restarting it while the pool is running.
+        """
+
+        if not self.running or self.workers[worker.index] is not worker:
+            return
+
+        self.workers[worker.index] = None
+        self.restarts += 1
+        self.logger.warn("Worker %i died (%s), restarting" % (worker.index, reason.getErrorMessage()))
+        self.reactor.callLater(self.restart_delay, self._respawn, worker.index)
+
+
+    def call(self, path, *args):
+
+        """
+        Run a function in a worker process.
+
+        :param path: Function path, e.g. "plugins.http:find_patterns".
+        :type path: str.
+        :returns: Deferred firing with the function's return value.
+        """
+
+        workers = [w for w in self.workers if w is not None]
+
+        if not self.running or not workers:
+            return defer.fail(WorkerError("No worker processes available"))
+
+        worker = min(workers, key=lambda w: len(w.pending))
+        d = defer.Deferred()
+
+        try:
+            worker.call(next(self._ids), path, args, d)
+        except Exception, e:
+            return defer.fail(WorkerError("Cannot send call to '%s': %s" % (path, e)))
+
+        return d
+
+
+    def stats(self):
+
+        """
+        Pool statistics.
+
+        :returns: dict
+        """
+
+        return dict(size=self.size,
+                    alive=len([w for w in self.workers if w is not None]),
+                    in_flight=sum(len(w.pending) for w in self.workers if w is not None),
+                    restarts=self.restarts)
+
+
+    def _respawn(self, index):
+
+        if self.running and self.workers[index] is None:
+            self.spawn(index)
+
+
+def worker_main():
+
+    """
+    Worker process loop: read call frames from stdin, write results to stdout.
+    """
+
+    stdin = os.fdopen(os.dup(sys.stdin.fileno()), "rb")
+    stdout = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    sys.stdout = sys.stderr
+
+    functions = dict()
+
+    while True:
+
+        header = stdin.read(HEADER.size)
+        if len(header) < HEADER.size: break
+
+        (length,) = HEADER.unpack(header)
+        request_id, path, args = cPickle.loads(stdin.read(length))
+
+        try:
+            args = cPickle.loads(args)
+            func = functions.get(path)
+            if func is None:
+                func = functions[path] = resolve(path)
+            data = frame((request_id, True, func(*args)))
+        except Exception:
+            data = frame((request_id, False, traceback.format_exc()))
+
+        stdout.write(data)
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    worker_main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the storage backends with the hub's persistence workload: plugin
+state reads and writes on a few hot names (config, tweet ids, script state)
+plus class queries for script resources.
+
+Usage: storebench.py [sqlite|mongo ...] [operations]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mhub"))
+
+from store import STORES, StoreError
+
+
+def open_store(backend, directory):
+
+    if backend == "sqlite":
+        return STORES[backend](os.path.join(directory, "bench.db"))
+
+    return STORES[backend]("localhost", 27017, "mhub_bench")
+
+
+def run(store, operations):
+
+    names = ["plugin.p%i.state" % (i) for i in range(20)]
+    tweet_ids = list()
+    results = dict()
+
+    start = time.time()
+    for i in xrange(operations):
+        store.set("cache", names[i % len(names)], {"count": i, "on": bool(i % 2)})
+    results["set"] = (operations, time.time() - start)
+
+    start = time.time()
+    for i in xrange(operations):
+        store.get("cache", names[i % len(names)])
+    results["get"] = (operations, time.time() - start)
+
+    start = time.time()
+    for i in xrange(operations):
+        store.get("cache", "plugin.twitter.tweet_ids")
+        tweet_ids.append(i)
+        store.set("cache", "plugin.twitter.tweet_ids", tweet_ids[-200:])
+    results["get+set"] = (operations, time.time() - start)
+
+    start = time.time()
+    batch = [(name, {"count": 0}) for name in names]
+    for i in xrange(operations / len(names)):
+        store.set_many("cache", batch)
+    results["set_many"] = (operations, time.time() - start)
+
+    start = time.time()
+    for i in xrange(operations / 10):
+        list(store.find("cache", {"value": {"count": 0, "on": False}}))
+    results["find"] = (operations / 10, time.time() - start)
+
+    return results
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    operations = int(args.pop()) if args and args[-1].isdigit() else 10000
+    backends = args or ["sqlite", "mongo"]
+    directory = tempfile.mkdtemp()
+
+    for backend in backends:
+        try:
+            store = open_store(backend, directory)
+        except StoreError, e:
+            print "%-8s skipped: %s" % (backend, e)
+            continue
+        for test, (count, elapsed) in sorted(run(store, operations).iteritems()):
+            print "%-8s %-10s %10.0f ops/s" % (backend, test, count / elapsed)
+        store.close()